@@ -31,6 +31,18 @@ def create_app(config_class=Config):
     bcrypt.init_app(app)
     csrf.init_app(app)
     
+    from app.utils.cache import broadcast_cache, dashboard_cache, post_cache, subscription_cache
+    post_cache.init_app(app, 'POST_CACHE')
+    subscription_cache.init_app(app, 'SUBSCRIPTION_CACHE')
+    dashboard_cache.init_app(app, 'DASHBOARD_CACHE')
+    broadcast_cache.init_app(app, 'BROADCAST_CACHE')
+    
+    from app.utils.search import search_index
+    search_index.init_app(app)
+    
+    from app.utils.outbox import outbox_workers
+    outbox_workers.init_app(app)
+    
     # Context processors
     @app.context_processor
     def inject_csrf_token():
@@ -52,6 +64,10 @@ def create_app(config_class=Config):
     app.register_blueprint(users)
     app.register_blueprint(notifications)
 
+    # Register CLI commands
+    from app.commands import register_commands
+    register_commands(app)
+
     # Create error handlers
     @app.errorhandler(404)
     def not_found_error(error):
@@ -0,0 +1,443 @@
+import click
+from sqlalchemy import func, inspect, or_, text
+from sqlalchemy.orm import aliased
+from app import db
+
+
+def _literal_default(column):
+    """Render a column's scalar Python default as a SQL literal, if it has one"""
+    default = column.default
+    if default is None or not default.is_scalar:
+        return None
+    value = default.arg
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return None
+
+
+# Values for columns added to tables that already have rows, where NULL would
+# mean something the existing rows are not
+ADDED_COLUMN_VALUES = {
+    # Notifications from before email existed count as emailed, so turning
+    # email on does not send a user their whole history
+    ('notification', 'emailed_at'): 'created_at',
+}
+
+
+def upgrade_schema():
+    """Bring an existing database up to date with the models.
+
+    New tables are created outright. Columns and indexes added to existing
+    models are added in place, so a database created by an older version of
+    ``init_db.py`` keeps its data.
+    """
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    changes = []
+
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                ddl = (f'ALTER TABLE {preparer.quote(table.name)} '
+                       f'ADD COLUMN {preparer.quote(column.name)} {column_type}')
+                default = _literal_default(column)
+                if default is not None:
+                    ddl += f' DEFAULT {default}'
+                connection.execute(text(ddl))
+                changes.append(f'added column {table.name}.{column.name}')
+                value = ADDED_COLUMN_VALUES.get((table.name, column.name))
+                if value is not None:
+                    connection.execute(text(
+                        f'UPDATE {preparer.quote(table.name)} SET {preparer.quote(column.name)} = {value}'
+                    ))
+                    changes.append(f'set {table.name}.{column.name} on existing rows')
+
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(db.engine)
+                changes.append(f'created index {index.name}')
+
+    # The full-text search table is dialect specific and not part of the models
+    from app.utils.search import search_index
+    search_index.ensure_schema()
+
+    # On MySQL the notification archive is split into monthly partitions
+    from app.utils.retention import ensure_archive_partitions
+    changes.extend(f'created partition notification_archive.{name}' for name in ensure_archive_partitions())
+
+    return changes
+
+
+def backfill_post_summaries(batch_size=500, recompute=False):
+    """Fill in the excerpt, word count and reading time of existing posts.
+
+    Posts are processed in id order, one committed batch at a time, so the
+    command can be interrupted and re-run safely. ``updated_at`` is left
+    untouched so backfilled posts do not show up as recently modified.
+    """
+    from app.models.post import Post
+
+    updated = 0
+    last_id = 0
+    while True:
+        query = Post.query.filter(Post.id > last_id)
+        if not recompute:
+            query = query.filter(Post.excerpt.is_(None))
+        batch = query.with_entities(Post.id, Post.content).order_by(Post.id).limit(batch_size).all()
+        if not batch:
+            break
+        for post_id, content in batch:
+            values = Post.summarize(content)
+            values['updated_at'] = Post.updated_at
+            db.session.query(Post).filter_by(id=post_id).update(values, synchronize_session=False)
+        last_id = batch[-1].id
+        updated += len(batch)
+        db.session.commit()
+    return updated
+
+
+def backfill_comment_paths(batch_size=500, recompute=False):
+    """Fill in the thread path and depth of existing comments.
+
+    Each batch only takes comments whose parent already has a path, so the
+    tree is filled in top-down, one level after another.
+    """
+    from app.models.comment import Comment
+
+    if recompute:
+        db.session.query(Comment).update({'path': None}, synchronize_session=False)
+        db.session.commit()
+
+    parent = aliased(Comment)
+    updated = 0
+    while True:
+        batch = db.session.query(
+            Comment.id, parent.path, parent.depth
+        ).outerjoin(
+            parent, Comment.parent_id == parent.id
+        ).filter(
+            Comment.path.is_(None),
+            or_(Comment.parent_id.is_(None), parent.path.isnot(None))
+        ).order_by(Comment.id).limit(batch_size).all()
+        if not batch:
+            break
+        for comment_id, parent_path, parent_depth in batch:
+            segment = Comment.path_segment(comment_id)
+            if parent_path is None:
+                values = {'path': segment, 'depth': 0}
+            else:
+                values = {'path': parent_path + segment, 'depth': parent_depth + 1}
+            db.session.query(Comment).filter_by(id=comment_id).update(values, synchronize_session=False)
+        updated += len(batch)
+        db.session.commit()
+    return updated
+
+
+def backfill_content_html(batch_size=500, recompute=False):
+    """Render the highlighted HTML of existing posts and comments.
+
+    Returns the number of posts and comments updated. As with the summary
+    backfill, ``updated_at`` of posts is left untouched.
+    """
+    from app.models.post import Post
+    from app.models.comment import Comment
+    from app.utils.highlight import highlight_code_blocks
+
+    def backfill(model):
+        updated = 0
+        last_id = 0
+        while True:
+            query = model.query.filter(model.id > last_id)
+            if not recompute:
+                query = query.filter(model.content_html.is_(None))
+            batch = query.with_entities(model.id, model.content).order_by(model.id).limit(batch_size).all()
+            if not batch:
+                break
+            for row_id, content in batch:
+                values = {'content_html': highlight_code_blocks(content)}
+                if model is Post:
+                    values['updated_at'] = Post.updated_at
+                db.session.query(model).filter_by(id=row_id).update(values, synchronize_session=False)
+            last_id = batch[-1].id
+            updated += len(batch)
+            db.session.commit()
+        return updated
+
+    return backfill(Post), backfill(Comment)
+
+
+def _reconcile_counter(model, counter, count_query, batch_size, extra_values=None):
+    """Compare a stored counter against real counts one id range at a time.
+
+    ``count_query(ids)`` returns (id, count) pairs for the given ids. Only
+    rows that disagree are written. Returns the number of rows repaired.
+    """
+    repaired = 0
+    last_id = 0
+    while True:
+        batch = db.session.query(model.id, counter).filter(
+            model.id > last_id
+        ).order_by(model.id).limit(batch_size).all()
+        if not batch:
+            break
+        ids = [row_id for row_id, _ in batch]
+        actual = dict(count_query(ids))
+        for row_id, stored in batch:
+            expected = actual.get(row_id, 0)
+            if stored != expected:
+                values = {counter.key: expected}
+                values.update(extra_values or {})
+                db.session.query(model).filter_by(id=row_id).update(values, synchronize_session=False)
+                repaired += 1
+        db.session.commit()
+        last_id = ids[-1]
+    return repaired
+
+
+def reconcile_comment_counts(batch_size=1000):
+    """Repair drift in Post.comment_count and Comment.reply_count.
+
+    Returns the number of posts and comments that were repaired.
+    """
+    from app.models.post import Post
+    from app.models.comment import Comment
+
+    posts_repaired = _reconcile_counter(
+        Post, Post.comment_count,
+        lambda ids: db.session.query(Comment.post_id, func.count(Comment.id)).filter(
+            Comment.post_id.in_(ids)
+        ).group_by(Comment.post_id).all(),
+        batch_size,
+        # Recounting comments doesn't count as editing the post
+        extra_values={'updated_at': Post.updated_at}
+    )
+    comments_repaired = _reconcile_counter(
+        Comment, Comment.reply_count,
+        lambda ids: db.session.query(Comment.parent_id, func.count(Comment.id)).filter(
+            Comment.parent_id.in_(ids)
+        ).group_by(Comment.parent_id).all(),
+        batch_size
+    )
+    return posts_repaired, comments_repaired
+
+
+def reconcile_post_counts(batch_size=1000):
+    """Repair drift in User.post_count.
+
+    Returns the number of users that were repaired.
+    """
+    from app.models.user import User
+    from app.models.post import Post
+
+    return _reconcile_counter(
+        User, User.post_count,
+        lambda ids: db.session.query(Post.user_id, func.count(Post.id)).filter(
+            Post.user_id.in_(ids)
+        ).group_by(Post.user_id).all(),
+        batch_size
+    )
+
+
+def reconcile_notification_counts(batch_size=1000):
+    """Repair drift in User.unread_notification_count.
+
+    Returns the number of users that were repaired.
+    """
+    from app.models.user import User
+    from app.models.notification import Notification
+
+    return _reconcile_counter(
+        User, User.unread_notification_count,
+        lambda ids: Notification.unread_counts_query(ids).all(),
+        batch_size
+    )
+
+
+def check_notification_query_plans(user_id=1):
+    """EXPLAIN the notification queries behind the notification routes.
+
+    Returns ``(name, plan lines, full scans)`` for each query; any full scan
+    means a route's query is missing an index. The queries come from the
+    same model methods the routes call, unexecuted.
+    """
+    from datetime import datetime, timedelta
+    from app.models.notification import Notification, NotificationStatus
+    from app.utils.explain import describe_plan, explain, full_scans
+
+    queries = {
+        'view_all': Notification.listing(user_id),
+        'view_all (unread)': Notification.listing(user_id, status=NotificationStatus.UNREAD),
+        'view_all (category)': Notification.listing(user_id, category_id=1),
+        'view_all (this week)': Notification.listing(user_id, since=datetime.now() - timedelta(days=7)),
+        'get_latest': Notification.latest_unread_query(user_id),
+        'get_latest_id': Notification.latest_id_query(user_id),
+        'stream / poll': Notification.unread_after_query(user_id, 0),
+        'delta': Notification.unread_after_query(user_id, 0, oldest_first=True),
+        'mark_all_read': Notification.select(user_id, status=NotificationStatus.UNREAD),
+        'comment / reply notification': Notification.unread_group_query(user_id, 'comment:post:1'),
+        'reconcile-notification-counts': Notification.unread_counts_query([user_id]),
+    }
+
+    dialect_name = db.engine.dialect.name
+    results = []
+    for name, query in queries.items():
+        plan = explain(db.session, query.statement)
+        results.append((name, describe_plan(plan, dialect_name), full_scans(plan, dialect_name)))
+    return results
+
+
+def register_commands(app):
+    """Register the maintenance commands with the ``flask`` CLI"""
+
+    @app.cli.command('upgrade-db')
+    def upgrade_db():
+        """Add missing tables, columns and indexes to the database."""
+        changes = upgrade_schema()
+        for change in changes:
+            click.echo(change)
+        click.echo(f'Database schema is up to date ({len(changes)} changes).')
+
+    @app.cli.command('backfill-post-summaries')
+    @click.option('--batch-size', default=500, show_default=True, help='Posts updated per transaction.')
+    @click.option('--all', 'recompute', is_flag=True, help='Recompute summaries that already exist.')
+    def backfill_post_summaries_command(batch_size, recompute):
+        """Compute plain-text excerpts for posts that do not have one."""
+        updated = backfill_post_summaries(batch_size=batch_size, recompute=recompute)
+        click.echo(f'Updated {updated} posts.')
+
+    @app.cli.command('backfill-comment-paths')
+    @click.option('--batch-size', default=500, show_default=True, help='Comments updated per transaction.')
+    @click.option('--all', 'recompute', is_flag=True, help='Recompute paths that already exist.')
+    def backfill_comment_paths_command(batch_size, recompute):
+        """Compute the thread path and depth of comments that do not have one."""
+        updated = backfill_comment_paths(batch_size=batch_size, recompute=recompute)
+        click.echo(f'Updated {updated} comments.')
+
+    @app.cli.command('backfill-content-html')
+    @click.option('--batch-size', default=500, show_default=True, help='Rows updated per transaction.')
+    @click.option('--all', 'recompute', is_flag=True, help='Re-render HTML that already exists.')
+    def backfill_content_html_command(batch_size, recompute):
+        """Highlight code blocks in posts and comments that have no rendered HTML."""
+        posts_updated, comments_updated = backfill_content_html(batch_size=batch_size, recompute=recompute)
+        click.echo(f'Updated {posts_updated} posts and {comments_updated} comments.')
+
+    @app.cli.command('reconcile-comment-counts')
+    @click.option('--batch-size', default=1000, show_default=True, help='Rows checked per transaction.')
+    def reconcile_comment_counts_command(batch_size):
+        """Recount comments and replies and repair stored counters that drifted."""
+        posts_repaired, comments_repaired = reconcile_comment_counts(batch_size=batch_size)
+        click.echo(f'Repaired {posts_repaired} post and {comments_repaired} comment counters.')
+
+    @app.cli.command('reconcile-post-counts')
+    @click.option('--batch-size', default=1000, show_default=True, help='Users checked per transaction.')
+    def reconcile_post_counts_command(batch_size):
+        """Recount users' posts and repair stored counters that drifted."""
+        repaired = reconcile_post_counts(batch_size=batch_size)
+        click.echo(f'Repaired {repaired} post counters.')
+
+    @app.cli.command('reconcile-notification-counts')
+    @click.option('--batch-size', default=1000, show_default=True, help='Users checked per transaction.')
+    def reconcile_notification_counts_command(batch_size):
+        """Recount unread notifications and repair stored counters that drifted."""
+        repaired = reconcile_notification_counts(batch_size=batch_size)
+        click.echo(f'Repaired {repaired} unread notification counters.')
+
+    @app.cli.command('archive-notifications')
+    @click.option('--batch-size', default=500, show_default=True, help='Notifications moved per transaction.')
+    @click.option('--to-file', 'archive_file', type=click.Path(dir_okay=False),
+                  help='Append to this gzipped JSON-lines file instead of the archive table.')
+    @click.option('--purge/--no-purge', default=True, show_default=True,
+                  help='Also delete archived notifications past NOTIFICATION_ARCHIVE_DAYS.')
+    def archive_notifications_command(batch_size, archive_file, purge):
+        """Archive notifications older than the NOTIFICATION_RETENTION rules."""
+        from app.utils.retention import (
+            archive_notifications, ensure_archive_partitions, parse_retention_rules, purge_archive
+        )
+
+        try:
+            rules = parse_retention_rules(app.config.get('NOTIFICATION_RETENTION'))
+        except ValueError as error:
+            raise click.ClickException(str(error))
+        for name in ensure_archive_partitions():
+            click.echo(f'Created partition {name}.')
+        for rule, count in archive_notifications(rules, batch_size=batch_size, archive_file=archive_file).items():
+            click.echo(f'Archived {count} notifications ({rule}).')
+
+        archive_days = app.config.get('NOTIFICATION_ARCHIVE_DAYS', 0)
+        if purge and archive_days:
+            dropped, deleted = purge_archive(archive_days)
+            for name in dropped:
+                click.echo(f'Dropped partition {name}.')
+            click.echo(f'Deleted {deleted} expired archived notifications.')
+
+    @app.cli.command('process-notification-outbox')
+    @click.option('--once', is_flag=True, help='Process the entries that are due, then exit.')
+    @click.option('--retry-failed', is_flag=True, help='First give failed entries another round of attempts.')
+    def process_notification_outbox_command(once, retry_failed):
+        """Create notifications from the outbox, as the web processes' workers do."""
+        from app.models.notification import NotificationOutbox
+        from app.utils.outbox import outbox_workers
+
+        if retry_failed:
+            retried = NotificationOutbox.query.filter_by(status=NotificationOutbox.STATUS_FAILED).update({
+                'status': NotificationOutbox.STATUS_PENDING,
+                'attempts': 0,
+                'available_at': func.now()
+            }, synchronize_session=False)
+            db.session.commit()
+            click.echo(f'Retrying {retried} failed entries.')
+        if once:
+            processed = outbox_workers.drain(app)
+            click.echo(f'Processed {processed} outbox entries.')
+            return
+        click.echo('Processing the notification outbox; press Ctrl+C to stop.')
+        outbox_workers.run(app)
+
+    @app.cli.command('send-notification-emails')
+    @click.option('--digest/--immediate', 'digest', default=None,
+                  help='Only send daily digests, or only immediate emails (default: both).')
+    def send_notification_emails_command(digest):
+        """Email opted-in users their new unread notifications."""
+        from app.utils.digest import send_notification_emails
+
+        for mode in ([digest] if digest is not None else [False, True]):
+            sent = send_notification_emails(app, digest=mode)
+            click.echo(f"Sent {sent} {'digest' if mode else 'immediate'} emails.")
+
+    @app.cli.command('check-query-plans')
+    @click.option('--user-id', default=1, show_default=True, help='User whose queries are explained.')
+    def check_query_plans_command(user_id):
+        """Fail if a notification route's query would scan a whole table."""
+        failures = 0
+        for name, plan, scans in check_notification_query_plans(user_id=user_id):
+            click.echo(f"{'FULL SCAN' if scans else 'ok'}: {name}")
+            for line in plan:
+                click.echo(f'    {line}')
+            failures += bool(scans)
+        if failures:
+            raise click.ClickException(f'{failures} queries scan a whole table.')
+        click.echo('No full table scans.')
+
+    @app.cli.command('rebuild-search-index')
+    @click.option('--batch-size', default=500, show_default=True, help='Documents indexed per transaction.')
+    def rebuild_search_index_command(batch_size):
+        """Re-index every post and comment for full-text search."""
+        from app.utils.search import search_index
+
+        if not search_index.available:
+            raise click.ClickException(f'Search is not supported on {db.engine.dialect.name}.')
+        indexed = search_index.rebuild(batch_size=batch_size)
+        click.echo(f'Indexed {indexed} posts and comments.')
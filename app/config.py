@@ -19,6 +19,92 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False 
     print(SQLALCHEMY_DATABASE_URI)
 
+    # Number of posts per page of the home feed
+    POSTS_PER_PAGE = int(os.environ.get('POSTS_PER_PAGE', 10))
+
+    # Number of comments, or replies to a comment, loaded at a time on a post page
+    COMMENTS_PER_PAGE = int(os.environ.get('COMMENTS_PER_PAGE', 10))
+
+    # Cache of rendered post pages. Each worker process keeps its own copy,
+    # so the timeout bounds how stale another worker's copy can get.
+    POST_CACHE_ENABLED = os.environ.get('POST_CACHE_ENABLED', 'true').lower() == 'true'
+    POST_CACHE_SIZE = int(os.environ.get('POST_CACHE_SIZE', 500))
+    POST_CACHE_TIMEOUT = int(os.environ.get('POST_CACHE_TIMEOUT', 60))
+
+    # Cache of users' notification subscriptions, consulted for every
+    # notification created. Changes made in another worker process are seen
+    # after at most the timeout.
+    SUBSCRIPTION_CACHE_ENABLED = os.environ.get('SUBSCRIPTION_CACHE_ENABLED', 'true').lower() == 'true'
+    SUBSCRIPTION_CACHE_SIZE = int(os.environ.get('SUBSCRIPTION_CACHE_SIZE', 10000))
+    SUBSCRIPTION_CACHE_TIMEOUT = int(os.environ.get('SUBSCRIPTION_CACHE_TIMEOUT', 300))
+
+    # Rows per page of the admin user and post tables
+    ADMIN_PER_PAGE = int(os.environ.get('ADMIN_PER_PAGE', 50))
+
+    # Cache of the admin dashboard's counts, which is also dropped when an
+    # admin approves, deletes or changes the role of a user
+    DASHBOARD_CACHE_ENABLED = os.environ.get('DASHBOARD_CACHE_ENABLED', 'true').lower() == 'true'
+    DASHBOARD_CACHE_TIMEOUT = int(os.environ.get('DASHBOARD_CACHE_TIMEOUT', 30))
+
+    # Cache of the newest broadcast's id. A broadcast sent from another
+    # worker process reaches this one's users after at most the timeout.
+    BROADCAST_CACHE_ENABLED = os.environ.get('BROADCAST_CACHE_ENABLED', 'true').lower() == 'true'
+    BROADCAST_CACHE_TIMEOUT = int(os.environ.get('BROADCAST_CACHE_TIMEOUT', 30))
+
+    # Live notifications. The stream keeps one request open per browser tab,
+    # so only enable it on an asynchronous worker (see README); otherwise
+    # pages check for changes every poll interval.
+    NOTIFICATION_STREAM_ENABLED = os.environ.get('NOTIFICATION_STREAM_ENABLED', 'false').lower() == 'true'
+    NOTIFICATION_POLL_INTERVAL = int(os.environ.get('NOTIFICATION_POLL_INTERVAL', 30))
+    # Streams are closed and reopened by the browser after the stream
+    # timeout; long polls return after the poll timeout. Waiting connections
+    # re-check the database at the recheck interval to pick up notifications
+    # created by other worker processes.
+    NOTIFICATION_STREAM_TIMEOUT = int(os.environ.get('NOTIFICATION_STREAM_TIMEOUT', 300))
+    NOTIFICATION_POLL_TIMEOUT = int(os.environ.get('NOTIFICATION_POLL_TIMEOUT', 25))
+    NOTIFICATION_RECHECK_INTERVAL = int(os.environ.get('NOTIFICATION_RECHECK_INTERVAL', 30))
+
+    # Notification retention, applied by `flask archive-notifications`. Rules
+    # are "<status>=<days>" for all categories or "<Category>.<status>=<days>"
+    # for one; older notifications are moved to the archive. Notifications
+    # with a status that has no rule are kept.
+    NOTIFICATION_RETENTION = os.environ.get('NOTIFICATION_RETENTION', 'read=90')
+    # Days archived notifications are kept, counted from when they were
+    # created; 0 keeps them forever
+    NOTIFICATION_ARCHIVE_DAYS = int(os.environ.get('NOTIFICATION_ARCHIVE_DAYS', 730))
+
+    # Background workers creating notifications from the outbox. Each web
+    # process runs NOTIFICATION_WORKERS threads (0 leaves the work to
+    # `flask process-notification-outbox`). Failed entries are retried after
+    # the retry delay, doubling each time, up to the maximum attempts.
+    NOTIFICATION_WORKERS = int(os.environ.get('NOTIFICATION_WORKERS', 1))
+    NOTIFICATION_WORKER_POLL_INTERVAL = int(os.environ.get('NOTIFICATION_WORKER_POLL_INTERVAL', 5))
+    NOTIFICATION_WORKER_BATCH_SIZE = int(os.environ.get('NOTIFICATION_WORKER_BATCH_SIZE', 50))
+    NOTIFICATION_WORKER_LEASE = int(os.environ.get('NOTIFICATION_WORKER_LEASE', 60))
+    NOTIFICATION_WORKER_MAX_ATTEMPTS = int(os.environ.get('NOTIFICATION_WORKER_MAX_ATTEMPTS', 8))
+    NOTIFICATION_WORKER_RETRY_DELAY = int(os.environ.get('NOTIFICATION_WORKER_RETRY_DELAY', 10))
+
+    # Outgoing mail. For local testing, run a debugging SMTP server that
+    # prints messages instead of delivering them:
+    #     python -m smtpd -n -c DebuggingServer localhost:1025
+    MAIL_SERVER = os.environ.get('MAIL_SERVER', 'localhost')
+    MAIL_PORT = int(os.environ.get('MAIL_PORT', 25))
+    MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', 'false').lower() == 'true'
+    MAIL_USE_SSL = os.environ.get('MAIL_USE_SSL', 'false').lower() == 'true'
+    MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
+    MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER', 'noreply@localhost')
+    # Messages sent over one SMTP connection before it is reopened
+    MAIL_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get('MAIL_MAX_MESSAGES_PER_CONNECTION', 100))
+    # Base URL of the site, for links in emails
+    SITE_URL = os.environ.get('SITE_URL', 'http://localhost:5000')
+
+    # Notification emails, sent by `flask send-notification-emails`. Users on
+    # immediate email get at most one email per minimum interval with
+    # everything new since the last; digest users get one per digest interval.
+    NOTIFICATION_EMAIL_MIN_INTERVAL = int(os.environ.get('NOTIFICATION_EMAIL_MIN_INTERVAL', 300))
+    NOTIFICATION_DIGEST_INTERVAL = int(os.environ.get('NOTIFICATION_DIGEST_INTERVAL', 86400))
+
 
 # ===============================
 
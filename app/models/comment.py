@@ -1,9 +1,14 @@
 from datetime import datetime
+from sqlalchemy.orm import joinedload
 from app import db
+from app.utils.highlight import highlight_code_blocks
+from app.utils.pagination import keyset_paginate
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
+    # Content as displayed, with code blocks highlighted when the comment is saved
+    content_html = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -16,6 +21,91 @@ class Comment(db.Model):
         cascade='all, delete-orphan'
     )
     
+    # Position in the thread, stored so a whole thread can be loaded and
+    # ordered with a single query. The path is the chain of zero-padded ids
+    # from the top-level comment down to this one, e.g. '0000000003/0000000012/'
+    depth = db.Column(db.Integer, default=0)
+    path = db.Column(db.String(500), nullable=True)
+    
+    # Number of direct replies, kept up to date as replies are added and deleted
+    reply_count = db.Column(db.Integer, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_comment_post_path', 'post_id', 'path'),
+        # Backs the paginated listing of a post's comments or a comment's replies
+        db.Index('ix_comment_post_parent_created', 'post_id', 'parent_id', 'created_at', 'id'),
+    )
+    
+    PATH_SEGMENT_WIDTH = 10
+    
+    @classmethod
+    def path_segment(cls, comment_id):
+        return f'{comment_id:0{cls.PATH_SEGMENT_WIDTH}d}/'
+    
+    def assign_path(self, parent=None):
+        """Set the path and depth of a new comment (it must already have an id)"""
+        if parent is None:
+            self.path = self.path_segment(self.id)
+            self.depth = 0
+        else:
+            if parent.path is None:
+                parent.assign_path(parent.parent)
+            self.path = parent.path + self.path_segment(self.id)
+            self.depth = parent.depth + 1
+    
+    def render_content(self):
+        """Recompute the displayed HTML from the content"""
+        self.content_html = highlight_code_blocks(self.content)
+    
+    @classmethod
+    def adjust_reply_count(cls, comment_id, delta):
+        """Atomically add ``delta`` to a comment's reply count in the current transaction"""
+        db.session.query(cls).filter_by(id=comment_id).update({
+            'reply_count': cls.reply_count + delta
+        }, synchronize_session=False)
+    
+    def subtree_ids(self):
+        """Ids of the comments removed when this one is deleted, itself included"""
+        if self.path is None:
+            return [self.id] + [reply.id for reply in self.get_all_replies()]
+        rows = db.session.query(Comment.id).filter(
+            Comment.post_id == self.post_id,
+            Comment.path.like(self.path + '%')
+        ).all()
+        return [comment_id for comment_id, in rows]
+    
+    @classmethod
+    def latest_created_at(cls, post_id):
+        """When the newest comment on a post was written, or None"""
+        return db.session.query(db.func.max(cls.created_at)).filter(cls.post_id == post_id).scalar()
+    
+    @classmethod
+    def page(cls, post_id, parent_id=None, cursor=None, per_page=10):
+        """One page of the top-level comments on a post, or of the replies to ``parent_id``.
+
+        Top-level comments are listed newest first and replies oldest first.
+        Replies of the returned comments are not loaded; fetch them with
+        another call passing the comment as ``parent_id``.
+        """
+        query = cls.query.filter_by(post_id=post_id, parent_id=parent_id).options(
+            joinedload(cls.author)
+        )
+        return keyset_paginate(query, cls.created_at, cls.id, cursor=cursor,
+                               per_page=per_page, descending=parent_id is None)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'post_id': self.post_id,
+            'parent_id': self.parent_id,
+            'author': self.author.full_name,
+            'author_username': self.author.username,
+            'content_html': self.content_html or self.content,
+            'depth': self.depth,
+            'reply_count': self.reply_count or 0,
+            'created_at': self.created_at.isoformat()
+        }
+    
     # Helper method to get all replies (nested)
     def get_all_replies(self):
         """Recursively get all replies to this comment"""
@@ -27,6 +117,8 @@ class Comment(db.Model):
     # Helper method to get reply depth
     def get_depth(self):
         """Get the nesting depth of this comment"""
+        if self.path is not None:
+            return self.depth
         if not self.parent_id:
             return 0
         depth = 1
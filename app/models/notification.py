@@ -1,5 +1,15 @@
-from datetime import datetime
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import case, event, literal, null, or_, union_all
+from sqlalchemy.orm import Session
 from app import db
+from app.models.user import User
+from app.utils.cache import broadcast_cache, subscription_cache
+from app.utils.events import notification_broker
 from enum import Enum
 
 # Define notification status
@@ -19,6 +29,89 @@ class NotificationCategory(db.Model):
     def __repr__(self):
         return f'<NotificationCategory {self.name}>'
 
+# A read-only copy of a category, safe to share between requests and threads
+CategoryInfo = namedtuple('CategoryInfo', ['id', 'name', 'description', 'icon'])
+
+# A user's notification preferences as cached (see NotificationSettings.subscriptions_for);
+# ``category_ids`` is None for every category
+Subscriptions = namedtuple('Subscriptions', ['push_enabled', 'email_enabled', 'email_digest', 'category_ids'])
+
+class CategoryRegistry:
+    """The notification categories, loaded once per process and looked up
+    by name or id without a query.
+
+    The registry is reloaded after a commit that adds, changes or deletes a
+    category in this process. Changes made by another process are picked up
+    after at most ``max_age`` seconds.
+    """
+    
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._generation = 0
+    
+    def _load(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() < snapshot['expires']:
+            return snapshot
+        with self._lock:
+            generation = self._generation
+            categories = tuple(
+                CategoryInfo(category.id, category.name, category.description, category.icon)
+                for category in NotificationCategory.query.order_by(NotificationCategory.id)
+            )
+            snapshot = {
+                'expires': time.monotonic() + self.max_age,
+                'all': categories,
+                'by_name': {category.name: category for category in categories},
+                'by_id': {category.id: category for category in categories}
+            }
+            # Don't keep what was read if the categories changed meanwhile
+            if generation == self._generation:
+                self._snapshot = snapshot
+        return snapshot
+    
+    def all(self):
+        return self._load()['all']
+    
+    def get(self, name):
+        """The category called ``name``, or None"""
+        return self._load()['by_name'].get(name)
+    
+    def get_by_id(self, category_id):
+        return self._load()['by_id'].get(category_id)
+    
+    def id_for(self, name):
+        """Id of the category called ``name``, or None if there is none"""
+        category = self.get(name)
+        return category.id if category else None
+    
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._snapshot = None
+
+category_registry = CategoryRegistry()
+
+@event.listens_for(Session, 'after_flush')
+def _note_category_changes(session, flush_context):
+    # Changes to a category's subscribers don't change the category itself
+    changed = [*session.new, *session.deleted] + [
+        instance for instance in session.dirty if session.is_modified(instance, include_collections=False)
+    ]
+    if any(isinstance(instance, NotificationCategory) for instance in changed):
+        session.info['notification_categories_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_category_registry(session):
+    if session.info.pop('notification_categories_changed', False):
+        category_registry.invalidate()
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_category_changes(session):
+    session.info.pop('notification_categories_changed', None)
+
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -26,6 +119,8 @@ class Notification(db.Model):
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=True)
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)
+    # The broadcast this notification is a user's receipt of
+    broadcast_id = db.Column(db.Integer, db.ForeignKey('broadcast.id'), nullable=True)
     
     # Notification types
     TYPE_COMMENT = 'comment'             # Someone commented on your post
@@ -44,17 +139,110 @@ class Notification(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.now)
     read_at = db.Column(db.DateTime)
     
+    # Activity on the same post or comment is folded into one unread
+    # notification per group key (see _notify_coalesced), counting the people
+    # involved and remembering the most recent of them
+    group_key = db.Column(db.String(64), nullable=True)
+    actor_count = db.Column(db.Integer, default=1)
+    recent_actors = db.Column(db.JSON, nullable=True)
+    MAX_RECENT_ACTORS = 3
+    
+    # When the notification was included in an email to the user (see
+    # app/utils/digest.py). Folding in new activity replaces the notification,
+    # so the new one is emailed again.
+    emailed_at = db.Column(db.DateTime, nullable=True)
+    
     # Relationships
     user = db.relationship('User', backref='notifications_received', foreign_keys=[user_id])
     sender = db.relationship('User', backref='notifications_sent', foreign_keys=[sender_id])
     
+    # Indexes for a user's notifications newest first, optionally narrowed by
+    # status or category (see `flask check-query-plans`)
+    __table_args__ = (
+        db.Index('ix_notification_user_status_created', 'user_id', 'status', 'created_at'),
+        db.Index('ix_notification_user_created', 'user_id', 'created_at'),
+        db.Index('ix_notification_user_category_created', 'user_id', 'category_id', 'created_at'),
+        # The admin history of system notifications, and receipts per broadcast
+        db.Index('ix_notification_category_type_created', 'category_id', 'notification_type', 'created_at'),
+        db.Index('ix_notification_broadcast_status', 'broadcast_id', 'status'),
+        # Users with unread notifications not emailed yet (see app/utils/digest.py)
+        db.Index('ix_notification_emailed_status_user', 'emailed_at', 'status', 'user_id'),
+        # The unread notification new activity is folded into (see _notify_coalesced)
+        db.Index('ix_notification_user_group_status', 'user_id', 'group_key', 'status'),
+    )
+    
     def __repr__(self):
         return f'<Notification {self.id}: {self.title[:20]}...>'
     
-    def mark_as_read(self):
+    def mark_as_read(self, commit=True):
+        """Mark this notification read; with ``commit=False`` the caller commits"""
+        if self.status == NotificationStatus.UNREAD:
+            User.adjust_unread_count(self.user_id, -1)
         self.status = NotificationStatus.READ
         self.read_at = datetime.now()
+        if commit:
+            db.session.commit()
+            notification_broker.publish(self.user_id)
+    
+    @classmethod
+    def select(cls, user_id, ids=None, category_id=None, start=None, end=None, status=None):
+        """Query of a user's notifications, optionally narrowed to ``ids``,
+        a category, a status, or those created in the [``start``, ``end``)
+        time range"""
+        query = cls.query.filter(cls.user_id == user_id)
+        if status is not None:
+            query = query.filter(cls.status == status)
+        if ids is not None:
+            query = query.filter(cls.id.in_(ids))
+        if category_id is not None:
+            query = query.filter(cls.category_id == category_id)
+        if start is not None:
+            query = query.filter(cls.created_at >= start)
+        if end is not None:
+            query = query.filter(cls.created_at < end)
+        return query
+    
+    @classmethod
+    def bulk_mark_read(cls, user_id, **selection):
+        """Mark the selected unread notifications read with one UPDATE.
+
+        Takes the same selection arguments as ``select()`` and returns the
+        number of notifications changed.
+        """
+        changed = cls.select(user_id, status=NotificationStatus.UNREAD, **selection).update({
+            'status': NotificationStatus.READ,
+            'read_at': datetime.now()
+        }, synchronize_session=False)
+        if changed:
+            User.adjust_unread_count(user_id, -changed)
+        db.session.commit()
+        notification_broker.publish(user_id)
+        return changed
+    
+    @classmethod
+    def bulk_mark_unread(cls, user_id, **selection):
+        """Mark the selected read notifications unread again with one UPDATE"""
+        changed = cls.select(user_id, status=NotificationStatus.READ, **selection).update({
+            'status': NotificationStatus.UNREAD,
+            'read_at': None
+        }, synchronize_session=False)
+        if changed:
+            User.adjust_unread_count(user_id, changed)
+        db.session.commit()
+        notification_broker.publish(user_id)
+        return changed
+    
+    @classmethod
+    def bulk_delete(cls, user_id, **selection):
+        """Delete the selected notifications with one DELETE"""
+        query = cls.select(user_id, **selection)
+        unread = cls.select(user_id, status=NotificationStatus.UNREAD, **selection).count()
+        deleted = query.delete(synchronize_session=False)
+        if unread:
+            User.adjust_unread_count(user_id, -unread)
         db.session.commit()
+        notification_broker.publish(user_id)
+        return deleted
     
     def to_dict(self):
         return {
@@ -65,89 +253,255 @@ class Notification(db.Model):
             'message': self.message,
             'link': self.link,
             'status': self.status.value,
+            'actor_count': self.actor_count or 1,
             'created_at': self.created_at.isoformat(),
             'read_at': self.read_at.isoformat() if self.read_at else None
         }
     
+    def to_preview_dict(self):
+        """The short form shown in notification toasts"""
+        return {
+            'id': self.id,
+            'title': self.title,
+            'message': self.message,
+            'category': self.category.name if self.category else None,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M'),
+            'link': self.link
+        }
+    
     @classmethod
-    def create_comment_notification(cls, post, comment, sender):
+    def listing(cls, user_id, category_id=None, status=None, since=None):
+        """Query of a user's notifications newest first, optionally only those
+        in a category, with a status or created since a time"""
+        query = cls.query.filter(cls.user_id == user_id)
+        if category_id is not None:
+            query = query.filter(cls.category_id == category_id)
+        if status is not None:
+            query = query.filter(cls.status == status)
+        if since is not None:
+            query = query.filter(cls.created_at >= since)
+        return query.order_by(cls.created_at.desc())
+    
+    @classmethod
+    def latest_unread_query(cls, user_id, limit=5):
+        return cls.listing(user_id, status=NotificationStatus.UNREAD).limit(limit)
+    
+    @classmethod
+    def latest_unread(cls, user_id, limit=5):
+        """The user's newest unread notifications"""
+        return cls.latest_unread_query(user_id, limit).all()
+    
+    @classmethod
+    def system_history(cls, system_category_id):
+        """Query of the system notifications sent, newest first, one row per send.
+
+        Notifications sent to each user separately are grouped by title,
+        message and link, with their number of recipients, how many were
+        read and when the latest was sent. Each broadcast is one row; its
+        receipt counts come from Broadcast.receipt_stats.
+        """
+        read = case((cls.status == NotificationStatus.READ, 1), else_=0)
+        per_user = db.select(
+            null().label('broadcast_id'),
+            cls.title, cls.message, cls.link,
+            db.func.count(cls.id).label('recipients'),
+            db.func.sum(read).label('read_count'),
+            db.func.max(cls.created_at).label('sent_at')
+        ).where(
+            cls.category_id == system_category_id,
+            cls.notification_type == cls.TYPE_SYSTEM,
+            cls.broadcast_id.is_(None)
+        ).group_by(cls.title, cls.message, cls.link)
+        broadcasts = db.select(
+            Broadcast.id, Broadcast.title, Broadcast.message, Broadcast.link,
+            literal(None, db.Integer), literal(None, db.Integer), Broadcast.created_at
+        )
+        history = union_all(per_user, broadcasts).subquery()
+        return db.session.query(history).order_by(history.c.sent_at.desc())
+    
+    def to_compact(self):
+        """The preview as a positional list, for compact delta responses:
+        [id, title, message, category, link, created_at as a Unix timestamp]"""
+        return [
+            self.id,
+            self.title,
+            self.message,
+            self.category.name if self.category else None,
+            self.link,
+            int(self.created_at.timestamp())
+        ]
+    
+    @classmethod
+    def unread_count_for(cls, user_id):
+        user = User.query.get(user_id)
+        return user.get_unread_notifications_count() if user else 0
+    
+    @classmethod
+    def unread_group_query(cls, user_id, group_key):
+        return cls.query.filter_by(user_id=user_id, group_key=group_key, status=NotificationStatus.UNREAD)
+    
+    @classmethod
+    def latest_id_query(cls, user_id):
+        return db.session.query(db.func.max(cls.id)).filter(cls.user_id == user_id)
+    
+    @classmethod
+    def latest_id_for(cls, user_id):
+        """Id of the user's newest notification, or 0"""
+        return cls.latest_id_query(user_id).scalar() or 0
+    
+    @classmethod
+    def unread_after_query(cls, user_id, last_id, limit=5, oldest_first=False):
+        return cls.query.filter(
+            cls.user_id == user_id,
+            cls.status == NotificationStatus.UNREAD,
+            cls.id > last_id
+        ).order_by(cls.id if oldest_first else cls.id.desc()).limit(limit)
+    
+    @classmethod
+    def unread_after(cls, user_id, last_id, limit=5, oldest_first=False):
+        """The user's newest unread notifications with an id above ``last_id``,
+        or the oldest of them with ``oldest_first``, to page through them all"""
+        return cls.unread_after_query(user_id, last_id, limit, oldest_first).all()
+    
+    @classmethod
+    def unread_counts_query(cls, user_ids):
+        """Query of (user id, unread notifications) for the users among ``user_ids`` with any"""
+        return db.session.query(cls.user_id, db.func.count(cls.id)).filter(
+            cls.user_id.in_(user_ids),
+            cls.status == NotificationStatus.UNREAD
+        ).group_by(cls.user_id)
+    
+    @classmethod
+    def describe_actors(cls, actors, actor_count):
+        """"Alice", "Alice and Bob" or "Alice and 14 others", most recent first"""
+        names = [actor['username'] for actor in actors]
+        if actor_count <= 1:
+            return names[0]
+        if actor_count == 2 and len(names) >= 2:
+            return f"{names[0]} and {names[1]}"
+        others = actor_count - 1
+        return f"{names[0]} and {others} other{'s' if others != 1 else ''}"
+    
+    @classmethod
+    def _notify_coalesced(cls, group_key, sender, describe, commit=True, **fields):
+        """Notify ``fields['user_id']`` of ``sender``'s activity, folding it into
+        their unread notification with the same ``group_key`` if there is one.
+        
+        ``describe`` builds the message from the description of the people
+        involved. A folded notification is replaced by a new one, at the top
+        of the list and pointing at the latest activity, but it stays one
+        unread notification.
+        People are counted once while they are among the most recent actors.
+        With ``commit=False`` the caller commits and wakes the recipient.
+        Returns None if the recipient doesn't want notifications of this kind.
+        """
+        if not NotificationSettings.wants(fields['user_id'], fields.get('category_id')):
+            return None
+        
+        actor = {'id': sender.id, 'username': sender.username}
+        # Folding replaces the notification, so concurrent folds for the same
+        # recipient queue up on their user row, which outlives it
+        db.session.query(User.id).filter(User.id == fields['user_id']).with_for_update().first()
+        notification = cls.unread_group_query(fields['user_id'], group_key).first()
+        
+        if notification is None:
+            notification = cls(
+                group_key=group_key,
+                sender_id=sender.id,
+                actor_count=1,
+                recent_actors=[actor],
+                message=describe(sender.username),
+                status=NotificationStatus.UNREAD,
+                **fields
+            )
+            db.session.add(notification)
+            User.adjust_unread_count(notification.user_id, 1)
+            if commit:
+                db.session.commit()
+                notification_broker.publish(notification.user_id)
+            return notification
+        
+        recent = notification.recent_actors or []
+        others = [other for other in recent if other['id'] != sender.id]
+        actor_count = notification.actor_count or 1
+        if len(others) == len(recent):
+            actor_count += 1
+        recent_actors = ([actor] + others)[:cls.MAX_RECENT_ACTORS]
+        
+        # Replaced rather than updated in place so that it gets a new id:
+        # streams, polls and delta cursors only look for ids above the newest
+        # they have seen. The unread count stays the same.
+        db.session.delete(notification)
+        replacement = cls(
+            group_key=group_key,
+            sender_id=sender.id,
+            actor_count=actor_count,
+            recent_actors=recent_actors,
+            message=describe(cls.describe_actors(recent_actors, actor_count)),
+            status=NotificationStatus.UNREAD,
+            **fields
+        )
+        db.session.add(replacement)
+        if commit:
+            db.session.commit()
+            notification_broker.publish(replacement.user_id)
+        return replacement
+    
+    @classmethod
+    def create_comment_notification(cls, post, comment, sender, commit=True):
         """Create a notification when someone comments on a post"""
         # Don't notify if the commenter is the post author
         if post.author.id == sender.id:
             return None
         
         # Get Comments category
-        comments_category = NotificationCategory.query.filter_by(name="Comments").first()
-            
-        notification = cls(
+        comments_category = category_registry.get("Comments")
+        
+        return cls._notify_coalesced(
+            f"comment:post:{post.id}",
+            sender,
+            lambda actors: f"{actors} commented on your post '{post.title}'",
+            commit=commit,
             user_id=post.author.id,
-            sender_id=sender.id,
             post_id=post.id,
             comment_id=comment.id,
             category_id=comments_category.id if comments_category else None,
             notification_type=cls.TYPE_COMMENT,
             title="New Comment",
-            message=f"{sender.username} commented on your post '{post.title}'",
-            link=f"/post/{post.id}#comment-{comment.id}",
-            status=NotificationStatus.UNREAD
+            link=f"/post/{post.id}#comment-{comment.id}"
         )
-        db.session.add(notification)
-        db.session.commit()
-        return notification
     
     @classmethod
-    def create_reply_notification(cls, comment, reply, sender):
+    def create_reply_notification(cls, comment, reply, sender, commit=True):
         """Create a notification when someone replies to a comment"""
         # Don't notify if the replier is the comment author
         if comment.author.id == sender.id:
             return None
         
         # Get Replies category
-        replies_category = NotificationCategory.query.filter_by(name="Replies").first()
-            
-        notification = cls(
+        replies_category = category_registry.get("Replies")
+        
+        return cls._notify_coalesced(
+            f"reply:comment:{comment.id}",
+            sender,
+            lambda actors: f"{actors} replied to your comment",
+            commit=commit,
             user_id=comment.author.id,
-            sender_id=sender.id,
             post_id=comment.post_id,
             comment_id=reply.id,
             category_id=replies_category.id if replies_category else None,
             notification_type=cls.TYPE_REPLY,
             title="New Reply",
-            message=f"{sender.username} replied to your comment",
-            link=f"/post/{comment.post_id}#comment-{reply.id}",
-            status=NotificationStatus.UNREAD
+            link=f"/post/{comment.post_id}#comment-{reply.id}"
         )
-        db.session.add(notification)
-        db.session.commit()
-        return notification
-    
-    @classmethod
-    def create_system_notification(cls, users, message, link=None, title="System Notification"):
-        """Create a system notification for multiple users"""
-        # Get System category
-        system_category = NotificationCategory.query.filter_by(name="System").first()
-        
-        notifications = []
-        for user in users:
-            notification = cls(
-                user_id=user.id,
-                category_id=system_category.id if system_category else None,
-                notification_type=cls.TYPE_SYSTEM,
-                title=title,
-                message=message,
-                link=link,
-                status=NotificationStatus.UNREAD
-            )
-            db.session.add(notification)
-            notifications.append(notification)
-        db.session.commit()
-        return notifications
     
     @classmethod
     def create_approval_notification(cls, user):
         """Create a notification when a user's account is approved"""
         # Get System category
-        system_category = NotificationCategory.query.filter_by(name="System").first()
+        system_category = category_registry.get("System")
+        if not NotificationSettings.wants(user.id, system_category.id if system_category else None):
+            return None
         
         notification = cls(
             user_id=user.id,
@@ -159,17 +513,19 @@ class Notification(db.Model):
             status=NotificationStatus.UNREAD
         )
         db.session.add(notification)
+        User.adjust_unread_count(notification.user_id, 1)
         db.session.commit()
+        notification_broker.publish(notification.user_id)
         return notification
 
     @classmethod
     def fix_missing_categories(cls):
         """Fix notifications with missing categories"""
         # Get all categories
-        comment_category = NotificationCategory.query.filter_by(name="Comments").first()
-        reply_category = NotificationCategory.query.filter_by(name="Replies").first()
-        mention_category = NotificationCategory.query.filter_by(name="Mentions").first()
-        system_category = NotificationCategory.query.filter_by(name="System").first()
+        comment_category = category_registry.get("Comments")
+        reply_category = category_registry.get("Replies")
+        mention_category = category_registry.get("Mentions")
+        system_category = category_registry.get("System")
         
         # Get notifications with missing categories
         notifications = cls.query.filter_by(category_id=None).all()
@@ -197,13 +553,323 @@ class Notification(db.Model):
             
         return updated_count
 
+class ArchivedNotification(db.Model):
+    """A notification moved out of the live table by the retention rules.
+
+    Only what the archive view shows is kept. The table has no foreign keys
+    and its primary key includes ``created_at``, so on MySQL it can be split
+    into monthly partitions and expired a whole month at a time (see
+    ``app/utils/retention.py``).
+    """
+    __tablename__ = 'notification_archive'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    created_at = db.Column(db.DateTime, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    category_id = db.Column(db.Integer)
+    notification_type = db.Column(db.String(20), nullable=False)
+    title = db.Column(db.String(100), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    link = db.Column(db.String(255), nullable=True)
+    status = db.Column(db.Enum(NotificationStatus), default=NotificationStatus.READ)
+    read_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.now)
+    
+    category = db.relationship(
+        'NotificationCategory',
+        primaryjoin='foreign(ArchivedNotification.category_id) == NotificationCategory.id',
+        viewonly=True
+    )
+    
+    __table_args__ = (
+        db.Index('ix_notification_archive_user_created', 'user_id', 'created_at'),
+    )
+    
+    # Columns copied over from Notification when archiving
+    COPIED_COLUMNS = ('id', 'created_at', 'user_id', 'category_id', 'notification_type',
+                      'title', 'message', 'link', 'status', 'read_at')
+    
+    def __repr__(self):
+        return f'<ArchivedNotification {self.id}: {self.title[:20]}...>'
+    
+    @classmethod
+    def listing(cls, user_id, category_id=None, status=None, since=None):
+        """Query of a user's archived notifications newest first, filtered like Notification.listing"""
+        query = cls.query.filter(cls.user_id == user_id)
+        if category_id is not None:
+            query = query.filter(cls.category_id == category_id)
+        if status is not None:
+            query = query.filter(cls.status == status)
+        if since is not None:
+            query = query.filter(cls.created_at >= since)
+        return query.order_by(cls.created_at.desc())
+
+class Broadcast(db.Model):
+    """An announcement sent to every approved user, stored once.
+
+    Sending one writes a single row however many users there are. Each
+    user's copy is created the next time they look at their notifications
+    (see ``deliver``); until then it counts towards their unread count as a
+    pending broadcast. Once delivered it is an ordinary notification that
+    can be read and deleted on its own. Users who don't want notifications
+    in the broadcast's category (see NotificationSettings.wants) get none.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('notification_category.id'))
+    title = db.Column(db.String(100), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    link = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    sender = db.relationship('User', foreign_keys=[sender_id])
+    category = db.relationship('NotificationCategory')
+    receipts = db.relationship('Notification', backref='broadcast', lazy='dynamic')
+    
+    def __repr__(self):
+        return f'<Broadcast {self.id}: {self.title[:20]}...>'
+    
+    @classmethod
+    def send(cls, title, message, link=None, sender=None):
+        """Store a broadcast for all approved users and wake their open connections"""
+        system_category = category_registry.get("System")
+        
+        broadcast = cls(
+            sender_id=sender.id if sender else None,
+            category_id=system_category.id if system_category else None,
+            title=title,
+            message=message,
+            link=link
+        )
+        db.session.add(broadcast)
+        db.session.commit()
+        broadcast_cache.delete('latest_id')
+        notification_broker.publish_all()
+        return broadcast
+    
+    @classmethod
+    def latest_id(cls):
+        """Id of the newest broadcast, or 0, from the broadcast cache"""
+        latest = broadcast_cache.get('latest_id')
+        if latest is None:
+            latest = db.session.query(db.func.max(cls.id)).scalar() or 0
+            broadcast_cache.set('latest_id', latest)
+        return latest
+    
+    @classmethod
+    def receipt_stats(cls, broadcast_ids):
+        """``{broadcast id: (receipts delivered, receipts read)}``"""
+        read = case((Notification.status == NotificationStatus.READ, 1), else_=0)
+        rows = db.session.query(
+            Notification.broadcast_id, db.func.count(Notification.id), db.func.sum(read)
+        ).filter(Notification.broadcast_id.in_(broadcast_ids)).group_by(Notification.broadcast_id)
+        return {broadcast_id: (delivered, read_count or 0) for broadcast_id, delivered, read_count in rows}
+    
+    @classmethod
+    def undelivered_for(cls, user):
+        """Query of the broadcasts sent to ``user`` past their watermark.
+
+        Users only receive broadcasts sent while they had an account, and
+        unapproved users receive none until they are approved.
+        """
+        if not user.is_approved:
+            return cls.query.filter(db.false())
+        query = cls.query.filter(cls.id > (user.last_broadcast_id or 0))
+        if user.created_at:
+            query = query.filter(cls.created_at >= user.created_at)
+        return query
+    
+    @classmethod
+    def pending_for(cls, user):
+        """Query of the undelivered broadcasts that ``user`` wants to receive"""
+        subscriptions = NotificationSettings.subscriptions_for([user.id])[user.id]
+        query = cls.undelivered_for(user)
+        if not subscriptions.push_enabled:
+            return query.filter(db.false())
+        if subscriptions.category_ids is not None:
+            query = query.filter(or_(cls.category_id.is_(None), cls.category_id.in_(subscriptions.category_ids)))
+        return query
+    
+    @classmethod
+    def deliver(cls, user_id):
+        """Turn the user's pending broadcasts into unread notifications.
+
+        Call before reading or changing the user's notifications. Returns
+        the number of notifications created. Broadcasts the user doesn't
+        want are passed over for good, as the watermark moves past them.
+        """
+        user = User.query.get(user_id)
+        latest = cls.latest_id()
+        if user is None or not user.is_approved or (user.last_broadcast_id or 0) >= latest:
+            return 0
+        undelivered = cls.undelivered_for(user).order_by(cls.id).all()
+        
+        # Move the watermark only if no concurrent request already did, so
+        # each broadcast is delivered to a user once. It also moves past
+        # broadcasts sent before the user joined, so later requests can tell
+        # from the watermark alone that nothing is pending.
+        watermark = max([latest] + [broadcast.id for broadcast in undelivered])
+        claimed = User.query.filter(
+            User.id == user_id,
+            User.last_broadcast_id == user.last_broadcast_id
+        ).update({'last_broadcast_id': watermark}, synchronize_session=False)
+        if not claimed:
+            # Leave the caller's work in the session alone; only the
+            # watermark is stale
+            db.session.expire(user, ['last_broadcast_id'])
+            return 0
+        
+        pending = [broadcast for broadcast in undelivered
+                   if NotificationSettings.wants(user_id, broadcast.category_id)]
+        for broadcast in pending:
+            db.session.add(Notification(
+                user_id=user_id,
+                sender_id=broadcast.sender_id,
+                broadcast_id=broadcast.id,
+                category_id=broadcast.category_id,
+                notification_type=Notification.TYPE_SYSTEM,
+                title=broadcast.title,
+                message=broadcast.message,
+                link=broadcast.link,
+                status=NotificationStatus.UNREAD,
+                created_at=broadcast.created_at
+            ))
+        User.adjust_unread_count(user_id, len(pending))
+        db.session.commit()
+        return len(pending)
+
+class NotificationOutbox(db.Model):
+    """Notification work recorded in the same transaction as the change
+    that causes it, and carried out later by the outbox workers.
+
+    An entry is deleted in the same transaction that creates its
+    notification, so each entry takes effect exactly once: a worker that
+    fails or dies part way leaves nothing behind, and the entry is retried
+    with increasing delays once its claim runs out. Entries that keep
+    failing are marked failed and left for inspection.
+    """
+    __tablename__ = 'notification_outbox'
+    
+    STATUS_PENDING = 'pending'
+    STATUS_FAILED = 'failed'
+    
+    # Kinds of work
+    KIND_COMMENT = 'comment'  # payload: comment_id, sender_id
+    KIND_REPLY = 'reply'      # payload: comment_id (the reply), sender_id
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(10), default=STATUS_PENDING, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # Not processed before this time (later after each failure)
+    available_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    # The worker that claimed the entry, and until when its claim holds
+    claimed_by = db.Column(db.String(32), nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        db.Index('ix_notification_outbox_status_available', 'status', 'available_at'),
+    )
+    
+    def __repr__(self):
+        return f'<NotificationOutbox {self.id}: {self.kind}>'
+    
+    @classmethod
+    def enqueue(cls, kind, **payload):
+        """Record notification work in the current transaction; the caller commits"""
+        entry = cls(kind=kind, payload=payload)
+        db.session.add(entry)
+        return entry
+    
+    @classmethod
+    def claim(cls, batch_size=50, lease=60):
+        """Claim up to ``batch_size`` due entries for ``lease`` seconds.
+
+        The claim is one conditional UPDATE, so concurrent workers never
+        claim the same entry while its lease holds.
+        """
+        now = datetime.now()
+        due = [
+            cls.status == cls.STATUS_PENDING,
+            cls.available_at <= now,
+            or_(cls.locked_until.is_(None), cls.locked_until < now)
+        ]
+        ids = [entry_id for (entry_id,) in db.session.query(cls.id).filter(*due).order_by(cls.id).limit(batch_size)]
+        if not ids:
+            return []
+        token = uuid.uuid4().hex
+        cls.query.filter(cls.id.in_(ids), *due).update({
+            'claimed_by': token,
+            'locked_until': now + timedelta(seconds=lease),
+            'attempts': cls.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        return cls.query.filter(cls.id.in_(ids), cls.claimed_by == token).order_by(cls.id).all()
+    
+    def perform(self):
+        """Create this entry's notification without committing; returns it, or
+        None if nobody needs notifying (e.g. the comment was deleted since)"""
+        from app.models.comment import Comment
+        
+        comment = Comment.query.get(self.payload['comment_id'])
+        sender = User.query.get(self.payload['sender_id'])
+        if comment is None or sender is None:
+            return None
+        if self.kind == self.KIND_COMMENT:
+            return Notification.create_comment_notification(comment.post, comment, sender, commit=False)
+        if self.kind == self.KIND_REPLY:
+            if comment.parent is None:
+                return None
+            return Notification.create_reply_notification(comment.parent, comment, sender, commit=False)
+        raise ValueError(f'Unknown notification outbox kind {self.kind!r}')
+    
+    @classmethod
+    def process_batch(cls, batch_size=50, lease=60, max_attempts=8, retry_delay=10):
+        """Claim and carry out a batch of due entries.
+
+        Returns the number of entries processed, successfully or not. A
+        failed entry is retried after ``retry_delay`` seconds, doubling with
+        each attempt, and marked failed after ``max_attempts``.
+        """
+        entries = cls.claim(batch_size, lease)
+        for entry in entries:
+            entry_id, token, attempts = entry.id, entry.claimed_by, entry.attempts
+            try:
+                notification = entry.perform()
+                # Only the holder of the claim may complete the entry; if the
+                # lease ran out and another worker took over, back off
+                completed = cls.query.filter_by(id=entry_id, claimed_by=token).delete(synchronize_session=False)
+                if not completed:
+                    db.session.rollback()
+                    continue
+                db.session.commit()
+                if notification is not None:
+                    notification_broker.publish(notification.user_id)
+            except Exception as error:
+                current_app.logger.exception('Notification outbox entry %s failed (attempt %s)', entry_id, attempts)
+                db.session.rollback()
+                failed = attempts >= max_attempts
+                cls.query.filter_by(id=entry_id, claimed_by=token).update({
+                    'status': cls.STATUS_FAILED if failed else cls.STATUS_PENDING,
+                    'available_at': datetime.now() + timedelta(seconds=retry_delay * 2 ** (attempts - 1)),
+                    'locked_until': None,
+                    'last_error': repr(error)[:1000]
+                }, synchronize_session=False)
+                db.session.commit()
+        return len(entries)
+
 class NotificationSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
-    # Email notification settings
-    email_enabled = db.Column(db.Boolean, default=True)
+    # Email notification settings. Email is opt-in.
+    email_enabled = db.Column(db.Boolean, default=False)
     email_digest = db.Column(db.Boolean, default=False)  # True for daily digest, False for immediate
+    # When the user was last sent notification email, to space out sends
+    last_emailed_at = db.Column(db.DateTime, nullable=True)
     
     # In-app notification settings
     push_enabled = db.Column(db.Boolean, default=True)
@@ -228,12 +894,75 @@ class NotificationSettings(db.Model):
             'updated_at': self.updated_at.isoformat()
         }
     
+    @classmethod
+    def subscriptions_for(cls, user_ids):
+        """``{user id: Subscriptions}`` for ``user_ids``.
+
+        Served from the subscription cache; users missing from it are loaded
+        together with two queries. Users without settings get the defaults
+        of create_default_settings: in-app notifications in every category
+        and no email until they turn it on.
+        """
+        subscriptions = {}
+        missing = []
+        for user_id in user_ids:
+            cached = subscription_cache.get(user_id)
+            if cached is None:
+                missing.append(user_id)
+            else:
+                subscriptions[user_id] = cached
+        
+        if missing:
+            loaded = {user_id: Subscriptions(True, False, False, None) for user_id in missing}
+            settings_rows = db.session.query(
+                cls.id, cls.user_id, cls.push_enabled, cls.email_enabled, cls.email_digest
+            ).filter(
+                cls.user_id.in_(missing)
+            ).all()
+            categories = {}
+            if settings_rows:
+                rows = db.session.query(
+                    notification_categories.c.settings_id, notification_categories.c.category_id
+                ).filter(notification_categories.c.settings_id.in_([row.id for row in settings_rows]))
+                for settings_id, category_id in rows:
+                    categories.setdefault(settings_id, set()).add(category_id)
+            for row in settings_rows:
+                loaded[row.user_id] = Subscriptions(
+                    bool(row.push_enabled), bool(row.email_enabled), bool(row.email_digest),
+                    frozenset(categories.get(row.id, ()))
+                )
+            for user_id, value in loaded.items():
+                subscription_cache.set(user_id, value)
+            subscriptions.update(loaded)
+        return subscriptions
+    
+    @classmethod
+    def recipients_wanting(cls, user_ids, category_id, channel='push'):
+        """The users among ``user_ids`` who want notifications in ``category_id``
+        in the app (``channel='push'``) or by email (``channel='email'``)"""
+        wanted = []
+        for user_id, subscriptions in cls.subscriptions_for(user_ids).items():
+            enabled = subscriptions.email_enabled if channel == 'email' else subscriptions.push_enabled
+            category_ids = subscriptions.category_ids
+            if enabled and (category_id is None or category_ids is None or category_id in category_ids):
+                wanted.append(user_id)
+        return wanted
+    
+    @classmethod
+    def wants(cls, user_id, category_id, channel='push'):
+        return bool(cls.recipients_wanting([user_id], category_id, channel))
+    
+    @classmethod
+    def invalidate(cls, user_id):
+        """Forget the cached subscriptions of a user whose settings changed"""
+        subscription_cache.delete(user_id)
+    
     @classmethod
     def create_default_settings(cls, user):
         """Create default notification settings for a new user"""
         settings = cls(
             user_id=user.id,
-            email_enabled=True,
+            email_enabled=False,
             email_digest=False,
             push_enabled=True
         )
@@ -249,6 +978,7 @@ class NotificationSettings(db.Model):
             
         db.session.add(settings)
         db.session.commit()
+        cls.invalidate(user.id)
         return settings
     
     def update_subscriptions(self, category_ids):
@@ -258,11 +988,13 @@ class NotificationSettings(db.Model):
             categories = NotificationCategory.query.filter(NotificationCategory.id.in_(category_ids)).all()
             self.subscribed_categories = categories
         db.session.commit()
+        self.invalidate(self.user_id)
         return self.subscribed_categories
     
     def is_subscribed_to(self, category_id):
         """Check if user is subscribed to a specific category"""
-        return any(category.id == category_id for category in self.subscribed_categories)
+        category_ids = self.subscriptions_for([self.user_id])[self.user_id].category_ids
+        return category_ids is None or category_id in category_ids
 
 # Association table for users' subscribed categories
 notification_categories = db.Table('notification_categories',
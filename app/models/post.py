@@ -1,21 +1,160 @@
 from datetime import datetime
+from flask import url_for
+from sqlalchemy import func, or_
+from sqlalchemy.orm import defer, joinedload
 from app import db
+from app.utils.highlight import highlight_code_blocks
+from app.utils.pagination import keyset_paginate
+from app.utils.search import prefix_match
+from app.utils.text import html_to_text, make_excerpt, reading_time
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text, nullable=False)
+    # Content as displayed, with code blocks highlighted when the post is saved
+    content_html = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     last_modified_by_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     is_hidden = db.Column(db.Boolean, default=False)
     
+    # Plain-text summary computed when the post is saved, so listings never
+    # need to load or strip the full HTML content
+    excerpt = db.Column(db.String(300), nullable=True)
+    word_count = db.Column(db.Integer, default=0)
+    reading_time = db.Column(db.Integer, default=1)  # Minutes
+    
+    # Number of comments and replies, kept up to date as comments are added
+    # and deleted (see `flask reconcile-comment-counts`)
+    comment_count = db.Column(db.Integer, default=0)
+    
     # Define the relationships explicitly with foreign_keys to avoid ambiguity
     author = db.relationship('User', foreign_keys=[user_id], backref='posts', lazy=True)
     last_modified_by = db.relationship('User', foreign_keys=[last_modified_by_id], lazy=True)
     
     comments = db.relationship('Comment', backref='post', lazy='dynamic', cascade='all, delete-orphan')
 
+    # Orderings of the admin post table; each one is backed by an index
+    ADMIN_SORTS = {'created': 'created_at', 'title': 'title', 'comments': 'comment_count'}
+
+    # Index backing the keyset-paginated feed, which orders by (created_at, id),
+    # and the indexes behind the admin post table's orderings and filters
+    __table_args__ = (
+        db.Index('ix_post_created_at_id', 'created_at', 'id'),
+        db.Index('ix_post_title_id', 'title', 'id'),
+        db.Index('ix_post_comment_count_id', 'comment_count', 'id'),
+        db.Index('ix_post_hidden_created_at_id', 'is_hidden', 'created_at', 'id'),
+        db.Index('ix_post_title_lower', func.lower(title)),
+    )
+
     def __repr__(self):
-        return f'<Post {self.title}>' 
\ No newline at end of file
+        return f'<Post {self.title}>'
+
+    @staticmethod
+    def summarize(content):
+        """Compute the excerpt, word count and reading time for HTML content"""
+        text = html_to_text(content)
+        word_count = len(text.split())
+        return {
+            'excerpt': make_excerpt(text, length=300),
+            'word_count': word_count,
+            'reading_time': reading_time(word_count)
+        }
+
+    def update_summary(self):
+        """Recompute the excerpt, word count and reading time from the content"""
+        for key, value in self.summarize(self.content).items():
+            setattr(self, key, value)
+
+    def render_content(self):
+        """Recompute the displayed HTML from the content"""
+        self.content_html = highlight_code_blocks(self.content)
+
+    @classmethod
+    def adjust_comment_count(cls, post_id, delta):
+        """Atomically add ``delta`` to a post's comment count in the current transaction"""
+        # updated_at is kept as is, since comments don't count as editing the post
+        db.session.query(cls).filter_by(id=post_id).update({
+            'comment_count': cls.comment_count + delta,
+            'updated_at': cls.updated_at
+        }, synchronize_session=False)
+
+    @staticmethod
+    def listing_options():
+        """Loader options for queries that list posts without showing their content"""
+        # Authors are joined in so listings don't issue a query per row
+        return [
+            defer(Post.content),
+            joinedload(Post.author),
+            joinedload(Post.last_modified_by)
+        ]
+
+    @staticmethod
+    def detail_options():
+        """Loader options for loading a single post to display in full"""
+        return [
+            joinedload(Post.author),
+            joinedload(Post.last_modified_by)
+        ]
+
+    @staticmethod
+    def visibility_filter(user):
+        """Return the filter restricting posts to those ``user`` may see, or None for admins"""
+        # Admins can see all posts
+        if user.is_authenticated and user.is_admin():
+            return None
+        # Other logged in users see visible posts plus their own hidden ones
+        if user.is_authenticated:
+            return or_(Post.is_hidden == False, Post.user_id == user.id)
+        # Anonymous visitors only see visible posts
+        return Post.is_hidden == False
+
+    def is_visible_to(self, user):
+        """Whether ``user`` may see this post"""
+        if not self.is_hidden:
+            return True
+        return user.is_authenticated and (user.id == self.user_id or user.is_admin())
+
+    @classmethod
+    def admin_page(cls, search=None, hidden=None, sort='created', descending=True, cursor=None, per_page=50):
+        """One keyset-paginated page of the admin post table.
+
+        ``search`` matches the start of the title in any case. ``sort`` is
+        one of ADMIN_SORTS.
+        """
+        query = cls.query.options(*cls.listing_options())
+        if search:
+            query = query.filter(prefix_match(cls.title, search))
+        if hidden is not None:
+            query = query.filter(cls.is_hidden == hidden)
+        sort_column = getattr(cls, cls.ADMIN_SORTS.get(sort, 'created_at'))
+        return keyset_paginate(query, sort_column, cls.id, cursor=cursor, per_page=per_page,
+                               descending=descending)
+
+    @classmethod
+    def visible_to(cls, user):
+        """Query of all posts visible to ``user``"""
+        query = cls.query
+        criterion = cls.visibility_filter(user)
+        if criterion is not None:
+            query = query.filter(criterion)
+        return query
+
+    def to_dict(self, preview_length=200):
+        preview = make_excerpt(self.excerpt or '', length=preview_length)
+        return {
+            'id': self.id,
+            'title': self.title,
+            'author': self.author.full_name,
+            'author_username': self.author.username,
+            'preview': preview,
+            'word_count': self.word_count,
+            'comment_count': self.comment_count,
+            'reading_time': self.reading_time,
+            'is_hidden': self.is_hidden,
+            'url': url_for('posts.post', post_id=self.id),
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        } 
\ No newline at end of file
@@ -1,6 +1,9 @@
 from flask_login import UserMixin
 from datetime import datetime
+from sqlalchemy import func, or_
 from app import db, login_manager, bcrypt
+from app.utils.pagination import keyset_paginate
+from app.utils.search import prefix_match
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
@@ -14,6 +17,28 @@ class User(db.Model, UserMixin):
     profile_picture = db.Column(db.String(120), default='default.jpg')
     bio = db.Column(db.Text, nullable=True)
     is_approved = db.Column(db.Boolean, default=False)
+    
+    # Number of unread notifications, kept up to date as notifications are
+    # created, read and deleted (see `flask reconcile-notification-counts`)
+    unread_notification_count = db.Column(db.Integer, default=0)
+    # Id of the newest broadcast already delivered to this user's
+    # notifications (see Broadcast.deliver)
+    last_broadcast_id = db.Column(db.Integer, default=0)
+    # Number of posts written, kept up to date as posts are created and
+    # deleted (see `flask reconcile-post-counts`)
+    post_count = db.Column(db.Integer, default=0)
+
+    # Orderings of the admin user table; each one is backed by an index
+    ADMIN_SORTS = {'created': 'created_at', 'username': 'username', 'posts': 'post_count'}
+
+    __table_args__ = (
+        db.Index('ix_user_created_at_id', 'created_at', 'id'),
+        db.Index('ix_user_post_count_id', 'post_count', 'id'),
+        db.Index('ix_user_approved_created_at_id', 'is_approved', 'created_at', 'id'),
+        db.Index('ix_user_role_created_at_id', 'role', 'created_at', 'id'),
+        db.Index('ix_user_username_lower', func.lower(username)),
+        db.Index('ix_user_email_lower', func.lower(email)),
+    )
 
     @property
     def full_name(self):
@@ -29,11 +54,76 @@ class User(db.Model, UserMixin):
         return self.role == 'admin'
     
     def get_unread_notifications_count(self):
-        from app.models.notification import Notification, NotificationStatus
-        return Notification.query.filter_by(
-            user_id=self.id, 
-            status=NotificationStatus.UNREAD
-        ).count()
+        return max(self.unread_notification_count or 0, 0) + self.pending_broadcast_count()
+    
+    def pending_broadcast_count(self):
+        """Number of broadcasts sent to this user but not yet delivered"""
+        from app.models.notification import Broadcast
+        
+        # Every page asks, so users past the newest broadcast are answered
+        # without a query
+        if (self.last_broadcast_id or 0) >= Broadcast.latest_id():
+            return 0
+        # Pages ask several times per request; the answer only changes when
+        # a delivery moves the watermark
+        cached = getattr(self, '_pending_broadcasts', None)
+        if cached is None or cached[0] != self.last_broadcast_id:
+            cached = (self.last_broadcast_id, Broadcast.pending_for(self).count())
+            self._pending_broadcasts = cached
+        return cached[1]
+    
+    @classmethod
+    def adjust_unread_count(cls, user_ids, delta):
+        """Atomically add ``delta`` to the unread notification count of users in the current transaction"""
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+        db.session.query(cls).filter(cls.id.in_(user_ids)).update({
+            'unread_notification_count': cls.unread_notification_count + delta
+        }, synchronize_session=False)
+    
+    @classmethod
+    def adjust_post_count(cls, user_id, delta):
+        """Atomically add ``delta`` to a user's post count in the current transaction"""
+        db.session.query(cls).filter_by(id=user_id).update({
+            'post_count': cls.post_count + delta
+        }, synchronize_session=False)
+    
+    @classmethod
+    def admin_page(cls, search=None, role=None, approved=None, sort='created', descending=True,
+                   cursor=None, per_page=50):
+        """One keyset-paginated page of the admin user table.
+
+        ``search`` matches the start of the username or email in any case,
+        using their lower() indexes. ``sort`` is one of ADMIN_SORTS.
+        """
+        query = cls.query
+        if search:
+            query = query.filter(or_(prefix_match(cls.username, search), prefix_match(cls.email, search)))
+        if role:
+            query = query.filter(cls.role == role)
+        if approved is not None:
+            query = query.filter(cls.is_approved == approved)
+        sort_column = getattr(cls, cls.ADMIN_SORTS.get(sort, 'created_at'))
+        return keyset_paginate(query, sort_column, cls.id, cursor=cursor, per_page=per_page,
+                               descending=descending)
+    
+    def to_admin_dict(self):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'full_name': self.full_name,
+            'email': self.email,
+            'role': self.role,
+            'is_approved': self.is_approved,
+            'post_count': self.post_count or 0,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+    
+    @classmethod
+    def reset_unread_count(cls, user_id):
+        db.session.query(cls).filter_by(id=user_id).update({
+            'unread_notification_count': 0
+        }, synchronize_session=False)
     
     def __repr__(self):
         return f'<User {self.username}>'
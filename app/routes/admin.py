@@ -1,11 +1,13 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, abort
+from flask import Blueprint, render_template, redirect, url_for, flash, request, abort, jsonify, current_app
 from flask_login import current_user, login_required
 from app import db
 from app.models.user import User
 from app.models.post import Post
 from functools import wraps
 from app.forms.admin import SystemNotificationForm
-from app.models.notification import Notification, NotificationCategory
+from app.models.notification import Broadcast, Notification, category_registry
+from app.utils.cache import broadcast_cache, dashboard_cache, post_cache, subscription_cache
+from app.utils.dashboard import dashboard_stats
 
 admin = Blueprint('admin', __name__)
 
@@ -18,36 +20,89 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def listing_args():
+    """Search, ordering and cursor of the admin tables, from the query string"""
+    return {
+        'search': request.args.get('q', '').strip() or None,
+        'sort': request.args.get('sort', 'created'),
+        'descending': request.args.get('order', 'desc') != 'asc',
+        'cursor': request.args.get('cursor'),
+        'per_page': current_app.config.get('ADMIN_PER_PAGE', 50)
+    }
+
+def flag_arg(name):
+    """A ``1``/``0`` query argument as True/False, or None if it is absent"""
+    value = request.args.get(name)
+    return value == '1' if value in ('0', '1') else None
+
+def listing_url(**changes):
+    """URL of the current admin table with some query arguments changed; None drops one"""
+    args = request.args.to_dict()
+    args.update(changes)
+    return url_for(request.endpoint, **{key: value for key, value in args.items() if value not in (None, '')})
+
+def users_json(users):
+    return jsonify({
+        'users': [user.to_admin_dict() for user in users],
+        'next_cursor': users.next_cursor,
+        'next_url': listing_url(cursor=users.next_cursor) if users.has_next else None
+    })
+
 @admin.route('/admin')
 @login_required
 @admin_required
 def admin_dashboard():
-    users = User.query.all()
-    posts = Post.query.all()
-    pending_users = User.query.filter_by(is_approved=False).all()
+    stats = dashboard_stats()
+    latest_posts = Post.query.options(*Post.listing_options()).order_by(Post.created_at.desc(), Post.id.desc()).limit(5).all()
+    latest_users = User.query.order_by(User.id.desc()).limit(5).all()
     return render_template('admin/dashboard.html', title='Admin Dashboard', 
-                          users=users, posts=posts, pending_users=pending_users)
+                          stats=stats, latest_posts=latest_posts, latest_users=latest_users)
+
+@admin.route('/admin/cache-stats')
+@login_required
+@admin_required
+def cache_stats():
+    """Hit/miss metrics of this worker's rendered page, subscription, dashboard and broadcast caches"""
+    return jsonify({
+        'post_cache': post_cache.stats(),
+        'subscription_cache': subscription_cache.stats(),
+        'dashboard_cache': dashboard_cache.stats(),
+        'broadcast_cache': broadcast_cache.stats()
+    })
 
 @admin.route('/admin/users')
 @login_required
 @admin_required
 def manage_users():
-    users = User.query.all()
-    return render_template('admin/users.html', title='Manage Users', users=users)
+    """One page of users, with ``format=json`` for scripts and the admin UI"""
+    users = User.admin_page(role=request.args.get('role') or None, approved=flag_arg('approved'), **listing_args())
+    if request.args.get('format') == 'json':
+        return users_json(users)
+    return render_template('admin/users.html', title='Manage Users', users=users, listing_url=listing_url)
 
 @admin.route('/admin/posts')
 @login_required
 @admin_required
 def manage_posts():
-    posts = Post.query.all()
-    return render_template('admin/posts.html', title='Manage Posts', posts=posts)
+    """One page of posts, with ``format=json`` for scripts and the admin UI"""
+    posts = Post.admin_page(hidden=flag_arg('hidden'), **listing_args())
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'posts': [post.to_dict() for post in posts],
+            'next_cursor': posts.next_cursor,
+            'next_url': listing_url(cursor=posts.next_cursor) if posts.has_next else None
+        })
+    return render_template('admin/posts.html', title='Manage Posts', posts=posts, listing_url=listing_url)
 
 @admin.route('/admin/pending_users')
 @login_required
 @admin_required
 def pending_users():
-    pending_users = User.query.filter_by(is_approved=False).all()
-    return render_template('admin/pending_users.html', title='Pending Users', users=pending_users)
+    pending_users = User.admin_page(approved=False, **listing_args())
+    if request.args.get('format') == 'json':
+        return users_json(pending_users)
+    return render_template('admin/pending_users.html', title='Pending Users', users=pending_users,
+                          listing_url=listing_url)
 
 @admin.route('/admin/user/<int:user_id>/approve', methods=['POST'])
 @login_required
@@ -56,6 +111,7 @@ def approve_user(user_id):
     user = User.query.get_or_404(user_id)
     user.is_approved = True
     db.session.commit()
+    dashboard_cache.clear()
     flash(f'User {user.username} has been approved!', 'success')
     return redirect(url_for('admin.pending_users'))
 
@@ -71,6 +127,7 @@ def delete_user(user_id):
         Post.query.filter_by(user_id=user.id).delete()
         db.session.delete(user)
         db.session.commit()
+        dashboard_cache.clear()
         flash(f'User {user.username} has been deleted!', 'success')
     return redirect(url_for('admin.manage_users'))
 
@@ -84,6 +141,7 @@ def toggle_role(user_id):
     else:
         user.role = 'admin' if user.role == 'user' else 'user'
         db.session.commit()
+        dashboard_cache.clear()
         flash(f'User {user.username} is now {user.role}!', 'success')
     return redirect(url_for('admin.manage_users'))
 
@@ -94,21 +152,16 @@ def create_system_notification():
     form = SystemNotificationForm()
     
     if form.validate_on_submit():
-        # Get all users or filter as needed
-        if form.all_users.data:
-            users = User.query.filter_by(is_approved=True).all()
-        else:
-            # In future, could add user selection logic here
-            users = User.query.filter_by(is_approved=True).all()
-        
         # Get title and customize the notification
         title = form.title.data
         message = form.message.data
         link = form.link.data if form.link.data else None
         
-        # Create the system notification
-        notification_count = len(users)
-        Notification.create_system_notification(users, message, link, title)
+        # Store the announcement once; each approved user subscribed to
+        # system notifications receives their copy the next time they
+        # check their notifications.
+        Broadcast.send(title, message, link, sender=current_user)
+        notification_count = User.query.filter_by(is_approved=True).count()
         
         flash(f'System notification sent to {notification_count} users.', 'success')
         return redirect(url_for('admin.admin_dashboard'))
@@ -123,90 +176,28 @@ def view_system_notifications():
     per_page = 10
     
     # Get all system notifications
-    system_category = NotificationCategory.query.filter_by(name="System").first()
+    system_category = category_registry.get("System")
     if not system_category:
         return render_template('admin/system_notifications.html', title='System Notifications History', 
                               notifications=None, grouped_notifications=[])
     
-    # Get all system notifications by creation time (newest first)
-    all_notifications = Notification.query.filter_by(
-        category_id=system_category.id,
-        notification_type=Notification.TYPE_SYSTEM
-    ).order_by(Notification.created_at.desc()).all()
+    # One row per send, grouped, ordered and paginated by the database
+    pagination = Notification.system_history(system_category.id).paginate(page=page, per_page=per_page, error_out=False)
+    stats = Broadcast.receipt_stats([row.broadcast_id for row in pagination.items if row.broadcast_id])
     
-    # Group notifications by content (title, message, link)
-    grouped_notifications = []
-    notification_groups = {}
-    
-    for notification in all_notifications:
-        # Create a key that identifies unique notifications
-        key = f"{notification.title}|{notification.message}|{notification.link or 'None'}"
-        
-        if key in notification_groups:
-            # Add this notification to existing group
-            notification_groups[key]['count'] += 1
-            notification_groups[key]['instances'].append(notification)
-            # Update the timestamp if this one is newer
-            if notification.created_at > notification_groups[key]['latest_timestamp']:
-                notification_groups[key]['latest_timestamp'] = notification.created_at
-        else:
-            # Create a new group
-            notification_groups[key] = {
-                'notification': notification,
-                'count': 1,
-                'instances': [notification],
-                'latest_timestamp': notification.created_at
-            }
-    
-    # Convert the grouped dictionary to a list sorted by latest timestamp
-    for key, group in notification_groups.items():
-        grouped_notifications.append({
-            'notification': group['notification'],
-            'count': group['count'],
-            'latest_timestamp': group['latest_timestamp']
+    history = []
+    for row in pagination.items:
+        recipients, read_count = (row.recipients, row.read_count or 0)
+        if row.broadcast_id:
+            recipients, read_count = stats.get(row.broadcast_id, (0, 0))
+        history.append({
+            'notification': row,
+            'broadcast': bool(row.broadcast_id),
+            'recipients': recipients,
+            'read_count': read_count,
+            'latest_timestamp': row.sent_at
         })
     
-    # Sort by the latest timestamp (newest first)
-    grouped_notifications.sort(key=lambda x: x['latest_timestamp'], reverse=True)
-    
-    # Manual pagination since we're grouping after the query
-    total_items = len(grouped_notifications)
-    total_pages = (total_items + per_page - 1) // per_page if total_items > 0 else 1  # Ceiling division
-    start_idx = (page - 1) * per_page
-    end_idx = min(start_idx + per_page, total_items)
-    current_page_items = grouped_notifications[start_idx:end_idx] if total_items > 0 else []
-    
-    # Create a pagination object with iter_pages method
-    class CustomPagination:
-        def __init__(self, items, page, per_page, total):
-            self.items = items
-            self.page = page
-            self.per_page = per_page
-            self.total = total
-            self.pages = (total + per_page - 1) // per_page if total > 0 else 1
-            self.has_prev = page > 1
-            self.has_next = page < self.pages
-            self.prev_num = page - 1
-            self.next_num = page + 1
-        
-        def iter_pages(self, left_edge=2, left_current=2, right_current=3, right_edge=2):
-            last = 0
-            for num in range(1, self.pages + 1):
-                if (num <= left_edge or
-                    (num > self.page - left_current - 1 and num < self.page + right_current) or
-                    num > self.pages - right_edge):
-                    if last + 1 != num:
-                        yield None
-                    yield num
-                    last = num
-    
-    pagination = CustomPagination(
-        items=current_page_items,
-        page=page,
-        per_page=per_page,
-        total=total_items
-    )
-    
     return render_template('admin/system_notifications.html', title='System Notifications History', 
-                          notifications=None, grouped_notifications=current_page_items, 
+                          notifications=None, grouped_notifications=history, 
                           pagination=pagination) 
\ No newline at end of file
@@ -1,33 +1,78 @@
-from flask import Blueprint, render_template, redirect, url_for
+from flask import Blueprint, render_template, redirect, url_for, request, jsonify, current_app
 from flask_login import current_user, login_required
 from app.models.post import Post
-from sqlalchemy import or_
+from app.utils.http import PageValidators
+from app.utils.pagination import keyset_paginate
+from app.utils.search import search_index
 
 main = Blueprint('main', __name__)
 
+def get_feed_page():
+    """Get one page of the home feed for the current visitor"""
+    per_page = current_app.config.get('POSTS_PER_PAGE', 10)
+    cursor = request.args.get('cursor')
+
+    # Hidden posts are filtered the same way for the HTML and JSON feeds
+    query = Post.visible_to(current_user).options(*Post.listing_options())
+    return keyset_paginate(query, Post.created_at, Post.id, cursor=cursor, per_page=per_page)
+
 @main.route('/')
 @main.route('/home')
 def home():
-    # For non-admin users, filter out hidden posts that aren't their own
-    if current_user.is_authenticated and not current_user.is_admin():
-        posts = Post.query.filter(
-            or_(
-                Post.is_hidden == False,
-                Post.user_id == current_user.id
-            )
-        ).order_by(Post.created_at.desc()).all()
-    # For admin users, show all posts
-    elif current_user.is_authenticated and current_user.is_admin():
-        posts = Post.query.order_by(Post.created_at.desc()).all()
-    # For non-authenticated users, only show non-hidden posts
-    else:
-        posts = Post.query.filter_by(is_hidden=False).order_by(Post.created_at.desc()).all()
+    posts = get_feed_page()
+    
+    # The page only changes when one of the listed posts does
+    validators = PageValidators(
+        [(post.id, post.updated_at, post.is_hidden, post.comment_count) for post in posts],
+        posts.next_cursor
+    )
+    not_modified = validators.not_modified()
+    if not_modified:
+        return not_modified
     
     # If user is not logged in, show a limited homepage with previews
     if not current_user.is_authenticated:
-        return render_template('restricted_home.html', posts=posts)
+        return validators.apply(render_template('restricted_home.html', posts=posts))
         
-    return render_template('home.html', posts=posts)
+    return validators.apply(render_template('home.html', posts=posts))
+
+@main.route('/home/feed')
+def home_feed():
+    """JSON variant of the home feed used for infinite scrolling"""
+    posts = get_feed_page()
+    preview_length = 200 if current_user.is_authenticated else 100
+    next_url = url_for('main.home_feed', cursor=posts.next_cursor) if posts.has_next else None
+    return jsonify({
+        'posts': [post.to_dict(preview_length=preview_length) for post in posts],
+        'next_cursor': posts.next_cursor,
+        'next_url': next_url
+    })
+
+@main.route('/search')
+def search():
+    """Ranked full-text search over the posts and comments the visitor may see"""
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config.get('POSTS_PER_PAGE', 10)
+    results, has_next = search_index.search(query, current_user, page=page, per_page=per_page)
+    
+    if request.args.get('format') == 'json':
+        next_url = url_for('main.search', q=query, page=page + 1, format='json') if has_next else None
+        return jsonify({
+            'query': query,
+            'results': [dict(result.to_dict(), url=result_url(result)) for result in results],
+            'next_url': next_url
+        })
+    
+    return render_template('search.html', title='Search', query=query, results=results,
+                           page=page, has_next=has_next, available=search_index.available,
+                           result_url=result_url)
+
+def result_url(result):
+    """Link to a search result, anchored at the comment for comment matches"""
+    if result.comment_id:
+        return url_for('posts.post', post_id=result.post_id, _anchor=f'comment-{result.comment_id}')
+    return url_for('posts.post', post_id=result.post_id)
 
 @main.route('/about')
 def about():
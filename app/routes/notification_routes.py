@@ -1,7 +1,9 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
+from flask import Blueprint, Response, abort, render_template, request, flash, redirect, url_for, jsonify, current_app
 from flask_login import login_required, current_user
 from datetime import datetime, timedelta
-from app.models.notification import Notification, NotificationCategory, NotificationStatus, NotificationSettings
+from app.models.notification import ArchivedNotification, Broadcast, Notification, NotificationStatus, NotificationSettings, category_registry
+from app.models.user import User
+from app.utils.events import notification_broker, watch_notifications, format_sse
 from app import db, csrf
 
 notifications = Blueprint('notifications', __name__)
@@ -16,46 +18,40 @@ def view_all():
     category = request.args.get('category')
     status = request.args.get('status')
     time_period = request.args.get('time_period')
+    # Show notifications moved to the archive by the retention rules instead
+    archived = request.args.get('archived') == '1'
     
-    # Base query
-    query = Notification.query.filter_by(user_id=current_user.id)
+    Broadcast.deliver(current_user.id)
     
     # Apply filters
-    if category and category != 'all':
-        query = query.filter_by(category_id=category)
-    
-    if status:
-        if status == 'read':
-            query = query.filter_by(status=NotificationStatus.READ)
-        elif status == 'unread':
-            query = query.filter_by(status=NotificationStatus.UNREAD)
+    category_id = int(category) if category and category.isdigit() else None
+    status_filter = {
+        'read': NotificationStatus.READ,
+        'unread': NotificationStatus.UNREAD
+    }.get(status)
     
+    since = None
     if time_period:
         now = datetime.now()
         if time_period == 'today':
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            query = query.filter(Notification.created_at >= start_date)
+            since = now.replace(hour=0, minute=0, second=0, microsecond=0)
         elif time_period == 'week':
-            start_date = now - timedelta(days=7)
-            query = query.filter(Notification.created_at >= start_date)
+            since = now - timedelta(days=7)
         elif time_period == 'month':
-            start_date = now - timedelta(days=30)
-            query = query.filter(Notification.created_at >= start_date)
+            since = now - timedelta(days=30)
     
-    # Order by created_at descending (newest first)
-    query = query.order_by(Notification.created_at.desc())
+    # Newest first
+    model = ArchivedNotification if archived else Notification
+    query = model.listing(current_user.id, category_id=category_id, status=status_filter, since=since)
     
     # Pagination
     notifications = query.paginate(page=page, per_page=per_page, error_out=False)
     
     # Get all notification categories for filter dropdown
-    categories = NotificationCategory.query.all()
+    categories = category_registry.all()
     
     # Count unread notifications
-    unread_count = Notification.query.filter_by(
-        user_id=current_user.id, 
-        status=NotificationStatus.UNREAD
-    ).count()
+    unread_count = current_user.get_unread_notifications_count()
     
     return render_template(
         'notifications.html',
@@ -64,59 +60,149 @@ def view_all():
         unread_count=unread_count,
         selected_category=category,
         selected_status=status,
-        selected_time_period=time_period
+        selected_time_period=time_period,
+        archived=archived
     )
 
 @notifications.route('/notifications/unread', methods=['GET'])
 @login_required
 def unread_count():
-    count = Notification.query.filter_by(
-        user_id=current_user.id,
-        status=NotificationStatus.UNREAD
-    ).count()
-    return jsonify({'count': count})
+    return jsonify({'count': current_user.get_unread_notifications_count()})
 
 @notifications.route('/notifications/latest', methods=['GET'])
 @login_required
 def get_latest():
     """Get the latest 5 unread notifications for the current user"""
     limit = request.args.get('limit', 5, type=int)
+    Broadcast.deliver(current_user.id)
     
     # Get the latest unread notifications
-    latest_notifications = Notification.query.filter_by(
-        user_id=current_user.id,
-        status=NotificationStatus.UNREAD
-    ).order_by(Notification.created_at.desc()).limit(limit).all()
+    latest_notifications = Notification.latest_unread(current_user.id, limit)
     
     # Convert to dictionaries
-    notifications = []
-    for notification in latest_notifications:
-        notification_dict = {
-            'id': notification.id,
-            'title': notification.title,
-            'message': notification.message,
-            'category': notification.category.name if notification.category else None,
-            'created_at': notification.created_at.strftime('%Y-%m-%d %H:%M'),
-            'link': notification.link
-        }
-        notifications.append(notification_dict)
+    notifications = [notification.to_preview_dict() for notification in latest_notifications]
     
     return jsonify({
         'notifications': notifications
     })
 
+@notifications.route('/notifications/delta', methods=['GET'])
+@login_required
+def delta():
+    """The unread count and the unread notifications newer than ``since_id``.
+
+    One call replaces fetching the latest id, the count and the latest
+    notifications separately. Notifications come oldest first, at most
+    ``limit`` of them; ``last_id`` is the id to ask from next, and
+    ``truncated`` says more are waiting. Without ``since_id`` no
+    notifications are returned and ``last_id`` is the user's newest id, to
+    start from.
+
+    The response's ETag identifies the count and ``last_id``, so a client
+    sending it back in If-None-Match gets an empty 304 while nothing
+    changed. Folding activity into a notification gives it a new id (see
+    Notification._notify_coalesced), so that changes both. With
+    ``compact=1`` the keys are shortened and notifications are positional
+    lists (see Notification.to_compact).
+    """
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    compact = request.args.get('compact') == '1'
+    
+    Broadcast.deliver(current_user.id)
+    if 'since_id' in request.args:
+        since_id = request.args.get('since_id', 0, type=int)
+        newer = Notification.unread_after(current_user.id, since_id, limit=limit + 1, oldest_first=True)
+        truncated = len(newer) > limit
+        newer = newer[:limit]
+        last_id = newer[-1].id if newer else since_id
+    else:
+        newer, truncated = [], False
+        last_id = Notification.latest_id_for(current_user.id)
+    count = current_user.get_unread_notifications_count()
+    
+    if compact:
+        payload = {'c': count, 'l': last_id, 'n': [notification.to_compact() for notification in newer], 't': truncated}
+    else:
+        payload = {
+            'count': count,
+            'last_id': last_id,
+            'notifications': [notification.to_preview_dict() for notification in newer],
+            'truncated': truncated
+        }
+    
+    response = jsonify(payload)
+    response.set_etag(f"{current_user.id}-{count}-{last_id}-{limit}{'c' if compact else ''}")
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def watch_current_user(timeout):
+    """Watch the current user's notifications from the request's ``last_id`` and ``count``.
+
+    Returns the id the watch starts from and the generator of changes.
+    Without a ``last_id`` only notifications created from now on are reported.
+    Waiting holds a worker, so watches are only served with
+    NOTIFICATION_STREAM_ENABLED.
+    """
+    if not current_app.config.get('NOTIFICATION_STREAM_ENABLED'):
+        abort(404)
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id')
+    last_id = int(last_id) if last_id and last_id.isdigit() else Notification.latest_id_for(current_user.id)
+    count = request.args.get('count', type=int)
+    app = current_app._get_current_object()
+    user_id = current_user.id
+    
+    # The request's database session is not needed while waiting; release
+    # its connection now rather than when the response finishes
+    db.session.remove()
+    return last_id, watch_notifications(app, user_id, last_id, count=count, timeout=timeout)
+
+@notifications.route('/notifications/stream', methods=['GET'])
+@login_required
+def stream():
+    """Server-Sent Events stream of unread count changes and new notifications.
+
+    The stream closes after NOTIFICATION_STREAM_TIMEOUT seconds and the
+    browser reconnects, resuming from the last event id it received.
+    """
+    last_id, changes = watch_current_user(current_app.config.get('NOTIFICATION_STREAM_TIMEOUT', 300))
+    
+    def events():
+        # Give the browser an event id to resume from even if nothing happens
+        yield format_sse(retry=3000, event_id=last_id)
+        for change in changes:
+            if change is None:
+                yield format_sse()
+                continue
+            yield format_sse({'count': change['count']}, event='count', event_id=change['last_id'])
+            # Oldest first, so toasts appear in the order the notifications arrived
+            for notification in reversed(change['notifications']):
+                yield format_sse(notification, event='notification')
+    
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Keep nginx from buffering the stream
+        'X-Accel-Buffering': 'no'
+    })
+
+@notifications.route('/notifications/poll', methods=['GET'])
+@login_required
+def poll():
+    """Long-poll fallback for the stream: answers on the first change, or after a timeout"""
+    last_id, changes = watch_current_user(current_app.config.get('NOTIFICATION_POLL_TIMEOUT', 25))
+    for change in changes:
+        if change is not None:
+            changes.close()
+            return jsonify(change)
+    # Nothing changed before the timeout
+    return jsonify({'count': request.args.get('count', type=int), 'notifications': [], 'last_id': last_id})
+
 @notifications.route('/notifications/latest_id', methods=['GET'])
 @login_required
 def get_latest_id():
     """Get the ID of the latest notification for the current user"""
-    latest_notification = Notification.query.filter_by(
-        user_id=current_user.id
-    ).order_by(Notification.id.desc()).first()
-    
-    latest_id = latest_notification.id if latest_notification else 0
-    
     return jsonify({
-        'latest_id': latest_id
+        'latest_id': Notification.latest_id_for(current_user.id)
     })
 
 @notifications.route('/notifications/<int:notification_id>', methods=['GET'])
@@ -150,7 +236,7 @@ def settings():
         user_settings = NotificationSettings.create_default_settings(current_user)
     
     # Get all notification categories
-    categories = NotificationCategory.query.all()
+    categories = category_registry.all()
     
     if request.method == 'POST':
         # Check if any settings were actually changed
@@ -181,6 +267,7 @@ def settings():
         # Only save and show message if changes were made
         if changes_made:
             db.session.commit()
+            NotificationSettings.invalidate(current_user.id)
             flash('Notification settings updated successfully', 'success')
         
         return redirect(url_for('notifications.settings'))
@@ -211,15 +298,8 @@ def mark_read(notification_id):
 @login_required
 @csrf.exempt
 def mark_all_read():
-    unread_notifications = Notification.query.filter_by(
-        user_id=current_user.id,
-        status=NotificationStatus.UNREAD
-    ).all()
-    
-    for notification in unread_notifications:
-        notification.mark_as_read()
-    
-    db.session.commit()
+    Broadcast.deliver(current_user.id)
+    Notification.bulk_mark_read(current_user.id)
     
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({'success': True, 'count': 0})
@@ -236,8 +316,11 @@ def delete_notification(notification_id):
         user_id=current_user.id
     ).first_or_404()
     
+    if notification.status == NotificationStatus.UNREAD:
+        User.adjust_unread_count(current_user.id, -1)
     db.session.delete(notification)
     db.session.commit()
+    notification_broker.publish(current_user.id)
     
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({'success': True})
@@ -252,8 +335,11 @@ def delete_notification(notification_id):
 @login_required
 @csrf.exempt
 def clear_all():
+    Broadcast.deliver(current_user.id)
     Notification.query.filter_by(user_id=current_user.id).delete()
+    User.reset_unread_count(current_user.id)
     db.session.commit()
+    notification_broker.publish(current_user.id)
     
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({'success': True})
@@ -264,6 +350,61 @@ def clear_all():
             flash('All notifications cleared', 'success')
         return redirect(url_for('notifications.view_all'))
 
+def parse_batch_time(value):
+    """Parse an ISO 8601 time from a batch request, or None if it is missing.
+
+    Notification times are naive server-local times, so a time with an
+    offset is converted to local time first.
+    """
+    if value in (None, ''):
+        return None
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+@notifications.route('/notifications/batch', methods=['POST'])
+@login_required
+def batch():
+    """Apply one state change to a selection of the current user's notifications.
+
+    Takes a JSON body with an ``action`` (``mark_read``, ``mark_unread`` or
+    ``delete``) and optionally narrows the selection with a list of ``ids``,
+    a ``category_id`` and an ``after``/``before`` time range. Without any of
+    them the action applies to all of the user's notifications.
+    """
+    actions = {
+        'mark_read': Notification.bulk_mark_read,
+        'mark_unread': Notification.bulk_mark_unread,
+        'delete': Notification.bulk_delete
+    }
+    data = request.get_json(silent=True) or {}
+    action = actions.get(data.get('action'))
+    if action is None:
+        return jsonify({'success': False, 'error': 'Unknown action'}), 400
+    
+    selection = {}
+    try:
+        if data.get('ids') is not None:
+            if not isinstance(data['ids'], list):
+                raise TypeError('ids must be a list')
+            selection['ids'] = [int(notification_id) for notification_id in data['ids']]
+        if data.get('category_id') is not None:
+            selection['category_id'] = int(data['category_id'])
+        selection['start'] = parse_batch_time(data.get('after'))
+        selection['end'] = parse_batch_time(data.get('before'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Invalid selection'}), 400
+    
+    Broadcast.deliver(current_user.id)
+    changed = action(current_user.id, **selection)
+    
+    return jsonify({
+        'success': True,
+        'changed': changed,
+        'count': current_user.get_unread_notifications_count()
+    })
+
 @notifications.route('/notifications/fix_categories', methods=['POST'])
 @login_required
 def fix_notification_categories():
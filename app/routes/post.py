@@ -3,15 +3,93 @@ from flask_login import current_user, login_required
 from app import db
 from app.models.post import Post
 from app.models.comment import Comment
+from app.models.user import User
 from app.forms.post import PostForm
 from app.forms.comment import CommentForm
-from app.models.notification import Notification
+from app.models.notification import NotificationOutbox
+from app.utils.cache import post_cache, post_viewer_class, invalidate_post
+from app.utils.http import PageValidators
+from app.utils.outbox import outbox_workers
+from app.utils.search import search_index
+from markupsafe import Markup
 from werkzeug.utils import secure_filename
 import os
 import uuid
+from datetime import timezone
 
 posts = Blueprint('posts', __name__)
 
+def add_comment(post, content, parent=None):
+    """Save a new comment, or a reply to ``parent``, by the current user.
+
+    The author of the post or parent comment is notified in the background.
+    """
+    comment = Comment(
+        content=content,
+        post=post,
+        author=current_user,
+        parent_id=parent.id if parent else None
+    )
+    comment.render_content()
+    db.session.add(comment)
+    # Flush to get the id needed for the comment's path in the thread
+    db.session.flush()
+    comment.assign_path(parent)
+    # Keep the denormalized counters in step within the same transaction
+    Post.adjust_comment_count(post.id, 1)
+    if parent:
+        Comment.adjust_reply_count(parent.id, 1)
+    search_index.index_comment(comment)
+    # Committed with the comment, so the notification can't be lost
+    NotificationOutbox.enqueue(
+        NotificationOutbox.KIND_REPLY if parent else NotificationOutbox.KIND_COMMENT,
+        comment_id=comment.id,
+        sender_id=current_user.id
+    )
+    db.session.commit()
+    invalidate_post(post.id)
+    outbox_workers.wake()
+    return comment
+
+def render_post_fragments(post):
+    """Render the post body and comment thread, or fetch them from the page cache.
+
+    Both fragments depend only on the post and the viewer class, never on the
+    session, so one rendering is shared by every viewer of that class.
+    """
+    viewer_class = post_viewer_class(post, current_user)
+    key = (post.id, viewer_class)
+    fragments = post_cache.get(key)
+    if fragments is None:
+        # Only the first page of top-level comments is rendered; replies and
+        # further pages are fetched from comment_page as the reader asks for them
+        comments = Comment.page(post.id, per_page=current_app.config.get('COMMENTS_PER_PAGE', 10))
+        next_url = comment_page_url(post.id, None, comments.next_cursor) if comments.has_next else None
+        fragments = (
+            Markup(render_template('post_article.html', post=post, viewer_class=viewer_class)),
+            Markup(render_template('comment_thread.html', post=post, comments=comments, next_url=next_url,
+                                   parent_id=None, viewer_class=viewer_class))
+        )
+        post_cache.set(key, fragments)
+    return fragments
+
+def post_page_validators(post):
+    """Validators for a post page, which changes with the post, its comments and the viewer class"""
+    latest_comment = Comment.latest_created_at(post.id)
+    viewer_class = post_viewer_class(post, current_user) if current_user.is_authenticated else None
+    # Posts are stamped in UTC but comments in local time, so the comment's
+    # time is converted before the two are compared
+    last_modified = max(filter(None, [
+        post.updated_at and post.updated_at.replace(tzinfo=timezone.utc),
+        post.created_at and post.created_at.replace(tzinfo=timezone.utc),
+        latest_comment and latest_comment.astimezone(timezone.utc)
+    ]))
+    return PageValidators(post.id, post.updated_at, post.is_hidden, post.comment_count, latest_comment,
+                          viewer_class, last_modified=last_modified)
+
+def comment_page_url(post_id, parent_id, cursor, response_format='html'):
+    return url_for('posts.comment_page', post_id=post_id, parent_id=parent_id, cursor=cursor, format=response_format)
+
 @posts.route('/post/new', methods=['GET', 'POST'])
 @login_required
 def new_post():
@@ -58,7 +136,13 @@ def new_post():
         try:
             # Create new post
             post = Post(title=title, content=content, author=current_user)
+            post.update_summary()
+            post.render_content()
             db.session.add(post)
+            User.adjust_post_count(current_user.id, 1)
+            # Flush to get the post id for its search index entry
+            db.session.flush()
+            search_index.index_post(post)
             db.session.commit()
             print(f"Successfully created post ID: {post.id}")
             flash('Your post has been created!', 'success')
@@ -77,24 +161,30 @@ def new_post():
 
 @posts.route('/post/<int:post_id>', methods=['GET', 'POST'])
 def post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(*Post.detail_options()).get_or_404(post_id)
     
     # If post is hidden and user is not the author or admin, abort with 404
-    if post.is_hidden and (not current_user.is_authenticated or 
-                          (current_user != post.author and not current_user.is_admin())):
+    if not post.is_visible_to(current_user):
         abort(404)
     
+    # Answer revalidation requests before loading comments or rendering anything
+    validators = post_page_validators(post) if request.method == 'GET' else None
+    if validators:
+        not_modified = validators.not_modified()
+        if not_modified:
+            return not_modified
+    
     # Check if user is logged in, if not redirect to restricted page
     if not current_user.is_authenticated:
         # Pass the post title and ID to the restricted page
-        return render_template('restricted_content.html', 
+        page = render_template('restricted_content.html', 
                               title=post.title, 
                               post_id=post.id,
-                              post_preview=post.content[:150] + '...' if len(post.content) > 150 else post.content)
+                              post_preview=post.excerpt[:150] + '...' if len(post.excerpt or '') > 150 else post.excerpt)
+        return validators.apply(page) if validators else page
     
     # Always create new form instances with CSRF tokens
     comment_form = CommentForm()
-    reply_form = CommentForm()
     
     # Handle POST request
     if request.method == 'POST':
@@ -121,46 +211,58 @@ def post(post_id):
         if parent_id:
             # This is a reply to another comment
             parent_comment = Comment.query.get_or_404(parent_id)
-            comment = Comment(
-                content=content,
-                post=post,
-                author=current_user,
-                parent_id=parent_comment.id
-            )
-            db.session.add(comment)
-            db.session.commit()
-            
-            # Create notification for reply
-            Notification.create_reply_notification(parent_comment, comment, current_user)
+            add_comment(post, content, parent=parent_comment)
             
             flash('Your reply has been posted.', 'success')
         else:
             # This is a new comment
-            comment = Comment(
-                content=content,
-                post=post,
-                author=current_user
-            )
-            db.session.add(comment)
-            db.session.commit()
-            
-            # Create notification for comment
-            Notification.create_comment_notification(post, comment, current_user)
+            add_comment(post, content)
             
             flash('Your comment has been posted.', 'success')
         
         return redirect(url_for('posts.post', post_id=post.id))
     
-    # Get all top-level comments (those without parent_id)
-    comments = Comment.query.filter_by(post_id=post.id, parent_id=None).order_by(Comment.created_at.desc()).all()
+    # Serve the post body and comment thread from the page cache when possible
+    article_html, comments_html = render_post_fragments(post)
     
     # Pass forms with CSRF tokens to the template
-    return render_template('post.html', 
+    return validators.apply(render_template('post.html', 
                           title=post.title, 
                           post=post, 
                           comment_form=comment_form, 
-                          reply_form=reply_form, 
-                          comments=comments)
+                          article_html=article_html, 
+                          comments_html=comments_html))
+
+@posts.route('/post/<int:post_id>/comments')
+@login_required
+def comment_page(post_id):
+    """One page of a post's top-level comments, or of the replies to ``parent_id``.
+
+    Returns JSON by default, or with ``format=html`` the rendered comments
+    followed by a button that loads the next page.
+    """
+    post = Post.query.get_or_404(post_id)
+    if not post.is_visible_to(current_user):
+        abort(404)
+    
+    parent_id = request.args.get('parent_id', type=int)
+    if parent_id is not None:
+        Comment.query.filter_by(id=parent_id, post_id=post.id).first_or_404()
+    
+    response_format = 'html' if request.args.get('format') == 'html' else 'json'
+    comments = Comment.page(post.id, parent_id=parent_id, cursor=request.args.get('cursor'),
+                            per_page=current_app.config.get('COMMENTS_PER_PAGE', 10))
+    next_url = comment_page_url(post.id, parent_id, comments.next_cursor, response_format) if comments.has_next else None
+    
+    if response_format == 'html':
+        return render_template('comment_page.html', post=post, comments=comments, next_url=next_url,
+                               parent_id=parent_id, viewer_class=post_viewer_class(post, current_user))
+    return jsonify({
+        'comments': [dict(comment.to_dict(), replies_url=comment_page_url(post.id, comment.id, None, response_format)
+                          if comment.reply_count else None) for comment in comments],
+        'next_cursor': comments.next_cursor,
+        'next_url': next_url
+    })
 
 @posts.route('/comment/<int:comment_id>/reply', methods=['POST'])
 @login_required
@@ -191,17 +293,7 @@ def reply_to_comment(comment_id):
     
     if form.validate():
         # Create a new reply
-        reply = Comment(
-            content=content,
-            post=post,
-            author=current_user,
-            parent_id=comment_id
-        )
-        db.session.add(reply)
-        db.session.commit()
-        
-        # Create notification for reply
-        Notification.create_reply_notification(parent_comment, reply, current_user)
+        add_comment(post, content, parent=parent_comment)
         
         flash('Your reply has been posted.', 'success')
     else:
@@ -265,9 +357,13 @@ def update_post(post_id):
         # Update post
         post.title = title
         post.content = content
+        post.update_summary()
+        post.render_content()
         # Track who last modified the post
         post.last_modified_by_id = current_user.id
+        search_index.index_post(post)
         db.session.commit()
+        invalidate_post(post.id)
         flash('Your post has been updated!', 'success')
         return redirect(url_for('posts.post', post_id=post.id))
         
@@ -315,9 +411,13 @@ def delete_post(post_id):
         # Get post details for confirmation message
         title = post.title
         
-        # Delete the post
+        # Delete the post and drop it and its comments from the search index
+        comment_ids = [comment_id for comment_id, in post.comments.with_entities(Comment.id)]
+        User.adjust_post_count(post.user_id, -1)
         db.session.delete(post)
+        search_index.remove_post(post_id, comment_ids)
         db.session.commit()
+        invalidate_post(post_id)
         
         flash(f'"{title}" has been deleted!', 'success')
         return redirect(url_for('main.home'))
@@ -340,9 +440,18 @@ def delete_comment(comment_id):
         # Get comment type for message
         comment_type = "reply" if comment.get_depth() > 0 else "comment"
         
-        # Delete the comment
+        # Replies to this comment are deleted with it, so count the whole subtree
+        removed_ids = comment.subtree_ids()
+        parent_id = comment.parent_id
+        
+        # Delete the comment and update the counters and search index in the same transaction
         db.session.delete(comment)
+        Post.adjust_comment_count(post_id, -len(removed_ids))
+        search_index.remove_comments(removed_ids)
+        if parent_id:
+            Comment.adjust_reply_count(parent_id, -1)
         db.session.commit()
+        invalidate_post(post_id)
         
         flash(f'Your {comment_type} has been deleted!', 'success')
         return redirect(url_for('posts.post', post_id=post_id))
@@ -363,6 +472,7 @@ def toggle_visibility(post_id):
     # Toggle visibility
     post.is_hidden = not post.is_hidden
     db.session.commit()
+    invalidate_post(post.id)
     
     status = "hidden" if post.is_hidden else "visible"
     flash(f'"{post.title}" is now {status}.', 'success')
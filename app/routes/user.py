@@ -7,6 +7,7 @@ from app import db
 from app.models.user import User
 from app.models.post import Post
 from app.forms.user import UpdateProfileForm, ChangePasswordForm
+from app.utils.http import PageValidators
 
 users = Blueprint('users', __name__)
 
@@ -77,6 +78,17 @@ def user_posts(username):
     else:
         posts_query = Post.query.filter_by(author=user, is_hidden=False)
     
-    posts = posts_query.order_by(Post.created_at.desc()).paginate(page=page, per_page=5)
+    posts = posts_query.options(*Post.listing_options()).order_by(Post.created_at.desc()).paginate(page=page, per_page=5)
     
-    return render_template('user/user_posts.html', posts=posts, user=user) 
\ No newline at end of file
+    # The page shows the profile and one page of posts
+    validators = PageValidators(
+        (user.id, user.username, user.first_name, user.last_name, user.email, user.bio, user.role,
+         user.profile_picture),
+        [(post.id, post.title, post.updated_at, post.is_hidden, post.comment_count) for post in posts.items],
+        page, posts.total
+    )
+    not_modified = validators.not_modified()
+    if not_modified:
+        return not_modified
+    
+    return validators.apply(render_template('user/user_posts.html', posts=posts, user=user)) 
\ No newline at end of file
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RenderCache:
+    """A small in-process LRU cache with expiry and hit/miss counters.
+
+    Entries live in the memory of one worker process, so an invalidation in
+    one process does not reach the others; ``timeout`` bounds how long any
+    other worker can keep serving a stale entry.
+    """
+
+    def __init__(self, name, max_entries=500, timeout=60):
+        self.name = name
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.enabled = True
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def init_app(self, app, prefix):
+        """Read ``<prefix>_ENABLED``, ``<prefix>_SIZE`` and ``<prefix>_TIMEOUT`` from the app config"""
+        self.enabled = app.config.get(f'{prefix}_ENABLED', self.enabled)
+        self.max_entries = app.config.get(f'{prefix}_SIZE', self.max_entries)
+        self.timeout = app.config.get(f'{prefix}_TIMEOUT', self.timeout)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, timeout=None):
+        if not self.enabled:
+            return
+        expires = time.monotonic() + (timeout if timeout is not None else self.timeout)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'timeout': self.timeout,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions
+            }
+
+
+# Rendered post bodies and comment threads, keyed by (post id, viewer class)
+post_cache = RenderCache('post_pages')
+
+# Users' notification subscriptions, keyed by user id (see
+# NotificationSettings.subscriptions_for)
+subscription_cache = RenderCache('notification_subscriptions', max_entries=10000, timeout=300)
+
+# Site-wide counts shown on the admin dashboard (see dashboard_stats)
+dashboard_cache = RenderCache('admin_dashboard', max_entries=1, timeout=30)
+
+# Id of the newest broadcast, so users already past it need no broadcast
+# queries (see Broadcast.latest_id)
+broadcast_cache = RenderCache('latest_broadcast', max_entries=1, timeout=30)
+
+# Viewer classes that see different markup on a post page
+VIEWER_CLASSES = ('author', 'admin', 'regular')
+
+
+def post_viewer_class(post, user):
+    """Which cached variant of a post page ``user`` should be served"""
+    if user.is_admin():
+        return 'admin'
+    if user.id == post.user_id:
+        return 'author'
+    return 'regular'
+
+
+def invalidate_post(post_id):
+    """Drop every cached variant of a post page"""
+    post_cache.delete(*[(post_id, viewer_class) for viewer_class in VIEWER_CLASSES])
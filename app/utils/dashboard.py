@@ -0,0 +1,51 @@
+from sqlalchemy import case, func
+from app.utils.cache import dashboard_cache
+
+
+def dashboard_stats():
+    """Site-wide counts for the admin dashboard.
+
+    Each table is counted with one grouped aggregate query rather than by
+    loading its rows, and the result is cached for DASHBOARD_CACHE_TIMEOUT
+    seconds so reloading the dashboard costs nothing.
+    """
+    stats = dashboard_cache.get('stats')
+    if stats is not None:
+        return stats
+
+    from app import db
+    from app.models.comment import Comment
+    from app.models.notification import Broadcast, Notification, NotificationOutbox
+    from app.models.post import Post
+    from app.models.user import User
+
+    stats = {
+        'users': 0, 'admins': 0, 'regular_users': 0, 'pending_users': 0,
+        'posts': 0, 'hidden_posts': 0, 'comments': 0,
+        'notifications': 0, 'unread_notifications': 0, 'broadcasts': 0, 'queued_notifications': 0
+    }
+
+    users = db.session.query(
+        User.role, User.is_approved, func.count(User.id), func.coalesce(func.sum(User.unread_notification_count), 0)
+    ).group_by(User.role, User.is_approved)
+    for role, is_approved, count, unread in users:
+        stats['users'] += count
+        stats['admins' if role == 'admin' else 'regular_users'] += count
+        if not is_approved:
+            stats['pending_users'] += count
+        # The per-user counters already hold the unread totals of delivered
+        # notifications; broadcasts count once they are delivered
+        stats['unread_notifications'] += unread
+
+    posts, hidden = db.session.query(
+        func.count(Post.id), func.coalesce(func.sum(case((Post.is_hidden == True, 1), else_=0)), 0)
+    ).one()
+    stats['posts'], stats['hidden_posts'] = posts, hidden
+
+    stats['comments'] = db.session.query(func.count(Comment.id)).scalar()
+    stats['notifications'] = db.session.query(func.count(Notification.id)).scalar()
+    stats['broadcasts'] = db.session.query(func.count(Broadcast.id)).scalar()
+    stats['queued_notifications'] = db.session.query(func.count(NotificationOutbox.id)).scalar()
+
+    dashboard_cache.set('stats', stats)
+    return stats
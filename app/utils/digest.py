@@ -0,0 +1,122 @@
+import smtplib
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from flask import render_template
+from app.utils.mail import mail_connection
+
+# Errors the server gives for one message, after which the connection can
+# still send the next; anything else ends the run
+RECIPIENT_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+def _pending_batches(digest, now, interval, batch_size):
+    """Yield ``[(user, notifications)]`` for users due an email, a batch at a time.
+
+    A user is due once their interval has passed since their last email and
+    they have unread notifications that were not emailed yet, in categories
+    they want by email. Preferences come from the same helper that decides
+    on in-app notifications, so users without settings get no email.
+    Each batch loads its users' notifications with a single query.
+    """
+    from app import db
+    from app.models.notification import Notification, NotificationSettings, NotificationStatus
+    from app.models.user import User
+
+    unemailed = [Notification.status == NotificationStatus.UNREAD, Notification.emailed_at.is_(None)]
+    last_user_id = 0
+    while True:
+        user_ids = [user_id for (user_id,) in db.session.query(Notification.user_id).filter(
+            Notification.user_id > last_user_id, *unemailed
+        ).distinct().order_by(Notification.user_id).limit(batch_size)]
+        if not user_ids:
+            return
+        last_user_id = user_ids[-1]
+
+        subscriptions = NotificationSettings.subscriptions_for(user_ids)
+        candidates = [user_id for user_id in user_ids
+                      if subscriptions[user_id].email_enabled and subscriptions[user_id].email_digest == digest]
+        last_emailed = dict(db.session.query(NotificationSettings.user_id, NotificationSettings.last_emailed_at).filter(
+            NotificationSettings.user_id.in_(candidates)
+        )) if candidates else {}
+        due_ids = [user_id for user_id in candidates
+                   if last_emailed.get(user_id) is None or last_emailed[user_id] <= now - timedelta(seconds=interval)]
+
+        pending = {}
+        if due_ids:
+            for notification in Notification.query.filter(
+                Notification.user_id.in_(due_ids), *unemailed
+            ).order_by(Notification.created_at.desc()):
+                if NotificationSettings.wants(notification.user_id, notification.category_id, channel='email'):
+                    pending.setdefault(notification.user_id, []).append(notification)
+
+        if pending:
+            users = User.query.filter(User.id.in_(list(pending))).order_by(User.id).all()
+            yield [(user, pending[user.id]) for user in users]
+        else:
+            db.session.rollback()
+
+
+def _build_message(app, user, notifications, digest):
+    context = dict(user=user, notifications=notifications, digest=digest,
+                   site_url=app.config.get('SITE_URL', '').rstrip('/'))
+    message = EmailMessage()
+    if digest:
+        message['Subject'] = f'Your daily digest: {len(notifications)} new notification{"s" if len(notifications) != 1 else ""}'
+    elif len(notifications) == 1:
+        message['Subject'] = notifications[0].title
+    else:
+        message['Subject'] = f'{len(notifications)} new notifications'
+    message['To'] = user.email
+    message.set_content(render_template('email/notifications.txt', **context))
+    message.add_alternative(render_template('email/notifications.html', **context), subtype='html')
+    return message
+
+
+def send_notification_emails(app, digest, now=None, batch_size=200):
+    """Email users their unread notifications that were not emailed yet.
+
+    ``digest`` selects the daily-digest users, otherwise the immediate ones,
+    who are sent at most one email per NOTIFICATION_EMAIL_MIN_INTERVAL. Each
+    batch of users is rendered in one pass and sent over one SMTP connection.
+    What was sent is recorded per notification (``emailed_at``) and per
+    user (``last_emailed_at``) right after each batch, so nothing is sent twice on the next run. A
+    message the server refuses is logged and retried on the next run,
+    without holding up the users after it.
+
+    Returns the number of emails sent.
+    """
+    from app import db
+    from app.models.notification import Notification, NotificationSettings
+
+    now = now or datetime.now()
+    interval = app.config.get('NOTIFICATION_DIGEST_INTERVAL' if digest else 'NOTIFICATION_EMAIL_MIN_INTERVAL')
+    sent = 0
+    with mail_connection(app) as connection:
+        for batch in _pending_batches(digest, now, interval, batch_size):
+            # Links in emails point at SITE_URL rather than at a request
+            with app.test_request_context(base_url=app.config.get('SITE_URL')):
+                messages = [(user, notifications, _build_message(app, user, notifications, digest))
+                            for user, notifications in batch]
+            delivered = []
+            try:
+                for user, notifications, message in messages:
+                    try:
+                        connection.send(message)
+                    except RECIPIENT_ERRORS:
+                        app.logger.exception('Could not email notifications to user %s', user.id)
+                        continue
+                    delivered.append((user, notifications))
+            finally:
+                # Record what went out even if a later send in the batch failed
+                if delivered:
+                    user_ids = [user.id for user, _ in delivered]
+                    Notification.query.filter(Notification.id.in_(
+                        [notification.id for _, notifications in delivered for notification in notifications]
+                    )).update({'emailed_at': now}, synchronize_session=False)
+                    NotificationSettings.query.filter(NotificationSettings.user_id.in_(user_ids)).update({
+                        'last_emailed_at': now,
+                        'updated_at': NotificationSettings.updated_at
+                    }, synchronize_session=False)
+                    db.session.commit()
+                sent += len(delivered)
+    return sent
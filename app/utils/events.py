@@ -0,0 +1,131 @@
+import json
+import threading
+import time
+
+
+class Listener:
+    """One waiting connection of a user, woken when their notifications change"""
+
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self._event = threading.Event()
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        """Block until notified or ``timeout`` seconds pass; True if notified"""
+        woken = self._event.wait(timeout)
+        self._event.clear()
+        return woken
+
+    def __enter__(self):
+        self.broker.add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.broker.remove(self)
+
+
+class NotificationBroker:
+    """Wakes the waiting stream and long-poll connections of users whose
+    notifications changed.
+
+    Listeners live in the memory of one worker process. Connections held by
+    other processes notice the change the next time they re-check the
+    database (see NOTIFICATION_RECHECK_INTERVAL).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = {}
+
+    def listen(self, user_id):
+        return Listener(self, user_id)
+
+    def add(self, listener):
+        with self._lock:
+            self._listeners.setdefault(listener.user_id, set()).add(listener)
+
+    def remove(self, listener):
+        with self._lock:
+            listeners = self._listeners.get(listener.user_id)
+            if listeners is not None:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[listener.user_id]
+
+    def publish(self, *user_ids):
+        """Wake every connection waiting on one of ``user_ids``"""
+        with self._lock:
+            listeners = [listener for user_id in user_ids for listener in self._listeners.get(user_id, ())]
+        for listener in listeners:
+            listener.notify()
+
+    def publish_all(self):
+        """Wake every waiting connection, e.g. after a broadcast"""
+        with self._lock:
+            listeners = [listener for listeners in self._listeners.values() for listener in listeners]
+        for listener in listeners:
+            listener.notify()
+
+
+notification_broker = NotificationBroker()
+
+
+def watch_notifications(app, user_id, last_id, count=None, timeout=300):
+    """Yield the user's notification changes until ``timeout`` seconds pass.
+
+    Each change is a dict with the unread ``count``, the unread
+    ``notifications`` newer than ``last_id`` and the new ``last_id``.
+    ``None`` is yielded whenever a check found nothing new, so callers can
+    send keep-alives.
+
+    The database is only used for the moment of each check, so a waiting
+    connection holds no database connection.
+    """
+    from app import db
+    from app.models.notification import Broadcast, Notification
+
+    recheck = app.config.get('NOTIFICATION_RECHECK_INTERVAL', 30)
+    deadline = time.monotonic() + timeout
+
+    with notification_broker.listen(user_id) as listener:
+        while True:
+            with app.app_context():
+                Broadcast.deliver(user_id)
+                unread = Notification.unread_count_for(user_id)
+                new = Notification.unread_after(user_id, last_id)
+                new_notifications = [notification.to_preview_dict() for notification in new]
+                db.session.remove()
+
+            if new_notifications:
+                last_id = max(notification['id'] for notification in new_notifications)
+            if unread != count or new_notifications:
+                count = unread
+                yield {'count': count, 'notifications': new_notifications, 'last_id': last_id}
+            else:
+                yield None
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            listener.wait(min(recheck, remaining))
+
+
+def format_sse(data=None, event=None, event_id=None, retry=None):
+    """Format one Server-Sent Events message"""
+    lines = []
+    if retry is not None:
+        lines.append(f'retry: {retry}')
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    if data is not None:
+        lines.append(f'data: {json.dumps(data)}')
+    if not lines:
+        # A comment line, which keeps the connection from idling out
+        lines.append(':')
+    return '\n'.join(lines) + '\n\n'
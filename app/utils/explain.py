@@ -0,0 +1,49 @@
+import re
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
+class Explain(Executable, ClauseElement):
+    """The query plan of a SELECT statement, as reported by the database"""
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    prefix = 'EXPLAIN QUERY PLAN' if compiler.dialect.name == 'sqlite' else 'EXPLAIN'
+    return f'{prefix} {compiler.process(element.statement, **kw)}'
+
+
+def explain(session, statement):
+    """Rows of the database's plan for ``statement``, as dicts"""
+    return [dict(row._mapping) for row in session.execute(Explain(statement))]
+
+
+_SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+
+def full_scans(plan, dialect_name):
+    """Descriptions of the steps in ``plan`` that read a whole table or index.
+
+    SQLite reports these as ``SCAN <table>``; MySQL as access type ``ALL``
+    (table scan) or ``index`` (full index scan).
+    """
+    scans = []
+    for row in plan:
+        if dialect_name == 'sqlite':
+            if _SQLITE_SCAN.match(row['detail']):
+                scans.append(row['detail'])
+        elif row.get('type') in ('ALL', 'index'):
+            scans.append(f"{row['table']}: access type {row['type']}")
+    return scans
+
+
+def describe_plan(plan, dialect_name):
+    """One line per step of ``plan``, for printing"""
+    if dialect_name == 'sqlite':
+        return [row['detail'] for row in plan]
+    return [f"{row['table']}: type={row['type']} key={row['key']} rows={row['rows']} {row.get('Extra') or ''}".rstrip()
+            for row in plan]
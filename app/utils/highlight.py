@@ -0,0 +1,82 @@
+import html
+import re
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+from pygments.lexers.special import TextLexer
+from pygments.util import ClassNotFound
+
+# Pygments style matching the atom-one-dark theme used by the editor preview
+PYGMENTS_STYLE = 'one-dark'
+
+# CSS class of highlighted blocks. app/static/css/pygments.css is generated
+# from pygments_css() and must be regenerated if the style changes
+HIGHLIGHT_CLASS = 'highlight'
+
+PRE_BLOCK = re.compile(r'<pre\b([^>]*)>(.*?)</pre>', re.IGNORECASE | re.DOTALL)
+LANGUAGE_CLASS = re.compile(r'\blang(?:uage)?-([\w+#-]+)', re.IGNORECASE)
+LINE_BREAK = re.compile(r'<br\s*/?>', re.IGNORECASE)
+TAG = re.compile(r'<[^>]+>')
+
+# Cheap language detection for blocks the editor saved without a language.
+# Pygments' own guess_lexer is unreliable on short snippets, so only the
+# languages people actually post here are recognized; anything else is
+# shown as plain text.
+LANGUAGE_HINTS = (
+    ('python', re.compile(r'^\s*(def|class)\s+\w+.*:\s*$|^\s*(import|from)\s+\w+', re.MULTILINE)),
+    ('sql', re.compile(r'\b(SELECT|INSERT INTO|UPDATE|DELETE FROM|CREATE TABLE)\b')),
+    ('html', re.compile(r'^\s*<(!DOCTYPE|html|div|p|span|script)\b', re.IGNORECASE)),
+    ('javascript', re.compile(r'\b(function|const|let|var)\s+\w+|=>|console\.')),
+    ('css', re.compile(r'^\s*[.#]?[\w-]+\s*\{[^}]*:[^}]*\}', re.MULTILINE)),
+    ('bash', re.compile(r'^\s*(\$ |sudo |pip |npm |cd |export )', re.MULTILINE)),
+)
+
+_formatter = HtmlFormatter(nowrap=True, style=PYGMENTS_STYLE)
+
+
+def _find_lexer(language, code):
+    if language:
+        try:
+            return get_lexer_by_name(language.lower())
+        except ClassNotFound:
+            pass
+    for name, pattern in LANGUAGE_HINTS:
+        if pattern.search(code):
+            return get_lexer_by_name(name)
+    return TextLexer()
+
+
+def _highlight_block(match):
+    attributes, inner = match.group(1), match.group(2)
+    language = LANGUAGE_CLASS.search(attributes) or LANGUAGE_CLASS.search(inner[:200])
+    language = language.group(1) if language else None
+
+    # Editors store code as escaped text, sometimes wrapped in <code> or with
+    # <br> line breaks, so drop the markup to get back the source code
+    code = html.unescape(TAG.sub('', LINE_BREAK.sub('\n', inner)))
+    lexer = _find_lexer(language, code)
+    highlighted = highlight(code, lexer, _formatter).rstrip('\n')
+
+    code_class = 'hljs'
+    if lexer.aliases:
+        code_class += f' language-{lexer.aliases[0]}'
+    return f'<pre class="{HIGHLIGHT_CLASS}"><code class="{code_class}">{highlighted}</code></pre>'
+
+
+def highlight_code_blocks(content):
+    """Return ``content`` with every <pre> block syntax highlighted by Pygments.
+
+    Highlighted blocks are wrapped as ``<pre class="highlight"><code>`` so
+    existing code block styles and the copy buttons keep working. Running it
+    again on its own output gives the same result.
+    """
+    if not content or '<pre' not in content.lower():
+        return content
+    return PRE_BLOCK.sub(_highlight_block, content)
+
+
+def pygments_css():
+    """Stylesheet for the token classes produced by ``highlight_code_blocks``"""
+    rules = HtmlFormatter(style=PYGMENTS_STYLE).get_style_defs(f'.{HIGHLIGHT_CLASS}')
+    # Leave out the global pre/line number rules so other code blocks are unaffected
+    return '\n'.join(line for line in rules.splitlines() if line.startswith(f'.{HIGHLIGHT_CLASS}')) + '\n'
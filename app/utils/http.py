@@ -0,0 +1,90 @@
+import hashlib
+import time
+from datetime import timezone
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+
+
+def viewer_validators():
+    """The parts of a page that depend on who is viewing it rather than on its content"""
+    # Every page embeds the session's CSRF token (see inject_csrf_token), and
+    # signed tokens expire after WTF_CSRF_TIME_LIMIT. Changing the validators
+    # twice per period keeps a revalidated page from carrying an expired token.
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    token_period = int(time.time() // (time_limit / 2)) if time_limit else 0
+    # Make sure the session has a token first, so the first response and
+    # later revalidations agree
+    generate_csrf()
+    csrf = (session.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')), token_period)
+
+    if not current_user.is_authenticated:
+        return ('anonymous',) + csrf
+    # The navigation bar shows the user's name, picture, role and unread count
+    return (
+        current_user.id,
+        current_user.username,
+        current_user.profile_picture,
+        current_user.role,
+        current_user.get_unread_notifications_count()
+    ) + csrf
+
+
+def _as_utc(value):
+    """``value`` in UTC to the second; naive datetimes are taken to be UTC already"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).replace(microsecond=0)
+
+
+class PageValidators:
+    """ETag and Last-Modified validators for a rendered page.
+
+    Build one from the data a page shows, before rendering it. If the client
+    already has the current version, ``not_modified()`` returns a 304
+    response and the page need not be rendered at all; otherwise pass the
+    rendered page to ``apply()`` to attach the validators.
+
+    Pages are marked private, since they embed the session's CSRF token and
+    user-specific navigation, and must be revalidated on every use.
+    """
+
+    def __init__(self, *parts, last_modified=None):
+        digest = hashlib.sha1(repr(parts + viewer_validators()).encode('utf-8'))
+        self.etag = digest.hexdigest()
+        self.last_modified = _as_utc(last_modified)
+        # A page showing flashed messages must never be reused from a cache,
+        # and answering 304 would leave the messages pending in the session
+        self.cacheable = request.method in ('GET', 'HEAD') and not session.get('_flashes')
+
+    def is_current(self):
+        """Whether the client's cached copy matches this version of the page"""
+        if not self.cacheable:
+            return False
+        # If-Modified-Since is only consulted when no ETag was sent, as the
+        # ETag also covers changes that don't move the modification time
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(self.etag)
+        if request.if_modified_since and self.last_modified:
+            return self.last_modified <= request.if_modified_since
+        return False
+
+    def not_modified(self):
+        """A 304 response if the client's copy is current, otherwise None"""
+        if not self.is_current():
+            return None
+        return self.apply(make_response('', 304))
+
+    def apply(self, response):
+        """Attach the validators and caching headers to ``response``"""
+        response = make_response(response)
+        if self.cacheable:
+            response.set_etag(self.etag, weak=True)
+            if self.last_modified:
+                response.last_modified = self.last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
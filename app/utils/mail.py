@@ -0,0 +1,64 @@
+import smtplib
+from contextlib import contextmanager
+
+
+class MailConnection:
+    """One SMTP connection reused for many messages.
+
+    The connection is opened with the first message and reopened when the
+    server drops it or after ``max_messages`` messages, so a long run of
+    sends never depends on a single session staying healthy.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.max_messages = config.get('MAIL_MAX_MESSAGES_PER_CONNECTION', 100)
+        self._smtp = None
+        self._sent = 0
+
+    def _open(self):
+        config = self.config
+        smtp_class = smtplib.SMTP_SSL if config.get('MAIL_USE_SSL') else smtplib.SMTP
+        smtp = smtp_class(config.get('MAIL_SERVER', 'localhost'), config.get('MAIL_PORT', 25), timeout=30)
+        if config.get('MAIL_USE_TLS'):
+            smtp.starttls()
+        if config.get('MAIL_USERNAME'):
+            smtp.login(config['MAIL_USERNAME'], config.get('MAIL_PASSWORD') or '')
+        self._smtp = smtp
+        self._sent = 0
+
+    def send(self, message):
+        """Send an ``email.message.EmailMessage``"""
+        if message['From'] is None:
+            message['From'] = self.config.get('MAIL_DEFAULT_SENDER')
+        if self._smtp is not None and self._sent >= self.max_messages:
+            self.close()
+        if self._smtp is None:
+            self._open()
+        try:
+            self._smtp.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # The server closed an idle connection; retry once on a new one
+            self._open()
+            self._smtp.send_message(message)
+        self._sent += 1
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        finally:
+            self._smtp = None
+
+
+@contextmanager
+def mail_connection(app):
+    """A MailConnection for ``app`` that is closed when the block ends"""
+    connection = MailConnection(app.config)
+    try:
+        yield connection
+    finally:
+        connection.close()
@@ -0,0 +1,76 @@
+import threading
+
+
+class OutboxWorkers:
+    """Background threads of this process that drain the notification outbox.
+
+    The threads start with the first entry written by this process. Each
+    commit that adds entries calls ``wake()`` so they are handled at once;
+    otherwise the threads look for due entries (retries, or entries written
+    by other processes) every ``poll_interval`` seconds. Any number of
+    processes may run workers, including ``flask process-notification-outbox``,
+    since entries are claimed before they are processed.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.workers = 1
+        self.poll_interval = 5
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+
+    def init_app(self, app):
+        """Read ``NOTIFICATION_WORKERS`` and ``NOTIFICATION_WORKER_POLL_INTERVAL`` from the app config"""
+        self.app = app
+        self.workers = app.config.get('NOTIFICATION_WORKERS', self.workers)
+        self.poll_interval = app.config.get('NOTIFICATION_WORKER_POLL_INTERVAL', self.poll_interval)
+
+    def wake(self):
+        """Have the workers look for new entries now, starting them if needed"""
+        if self.app is None or not self.workers:
+            return
+        with self._lock:
+            if not self._threads:
+                for number in range(self.workers):
+                    thread = threading.Thread(target=self.run, name=f'notification-worker-{number}', daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        self._wakeup.set()
+
+    def drain(self, app):
+        """Process due entries until none are left; returns how many were processed"""
+        from app import db
+        from app.models.notification import NotificationOutbox
+
+        config = app.config
+        processed = 0
+        with app.app_context():
+            try:
+                while True:
+                    count = NotificationOutbox.process_batch(
+                        batch_size=config.get('NOTIFICATION_WORKER_BATCH_SIZE', 50),
+                        lease=config.get('NOTIFICATION_WORKER_LEASE', 60),
+                        max_attempts=config.get('NOTIFICATION_WORKER_MAX_ATTEMPTS', 8),
+                        retry_delay=config.get('NOTIFICATION_WORKER_RETRY_DELAY', 10)
+                    )
+                    if not count:
+                        return processed
+                    processed += count
+            finally:
+                db.session.remove()
+
+    def run(self, app=None):
+        """Drain the outbox whenever woken or every ``poll_interval`` seconds, forever"""
+        app = app or self.app
+        while True:
+            try:
+                self.drain(app)
+            except Exception:
+                # e.g. the database is unreachable; try again at the next poll
+                app.logger.exception('Notification outbox worker failed')
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+outbox_workers = OutboxWorkers()
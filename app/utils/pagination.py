@@ -0,0 +1,91 @@
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+from sqlalchemy.types import DateTime
+
+
+class KeysetPage:
+    """A single page of results from a keyset (cursor) paginated query"""
+
+    def __init__(self, items, next_cursor, per_page):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.per_page = per_page
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+def encode_cursor(value, row_id):
+    """Encode a (sort value, id) pair as an opaque URL-safe token"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, row_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, sort_column=None):
+    """Decode a cursor token back into a (sort value, id) pair.
+
+    Returns None if the token is missing or malformed, so a bad cursor
+    simply restarts from the first page.
+    """
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if value is not None and sort_column is not None and isinstance(sort_column.type, DateTime):
+            value = datetime.fromisoformat(value)
+        return value, int(row_id)
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+
+def keyset_paginate(query, sort_column, id_column, cursor=None, per_page=10, descending=True):
+    """Fetch one page of ``query`` ordered by ``(sort_column, id_column)``.
+
+    Rows are located with a range predicate on the ordering key instead of an
+    OFFSET, so the cost of a page depends on ``per_page`` and not on how deep
+    into the table the cursor points.
+    """
+    position = decode_cursor(cursor, sort_column)
+    if position is not None:
+        value, row_id = position
+        if descending:
+            query = query.filter(or_(
+                sort_column < value,
+                and_(sort_column == value, id_column < row_id)
+            ))
+        else:
+            query = query.filter(or_(
+                sort_column > value,
+                and_(sort_column == value, id_column > row_id)
+            ))
+
+    if descending:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(sort_column.asc(), id_column.asc())
+
+    # Fetch one extra row to find out whether there is a next page
+    rows = query.limit(per_page + 1).all()
+    items = rows[:per_page]
+
+    next_cursor = None
+    if len(rows) > per_page:
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, sort_column.key), getattr(last, id_column.key))
+
+    return KeysetPage(items, next_cursor, per_page)
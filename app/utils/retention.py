@@ -0,0 +1,227 @@
+import gzip
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, select, text
+
+
+def parse_retention_rules(spec):
+    """Parse retention rules such as ``"read=90,unread=365,System.read=30"``.
+
+    Each rule is ``<status>=<days>`` for every category or
+    ``<category>.<status>=<days>`` for one category. Returns a dict mapping
+    ``(category name or None, status)`` to days.
+    """
+    from app.models.notification import NotificationStatus
+
+    rules = {}
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        key, _, days = part.partition('=')
+        category, _, status = key.strip().rpartition('.')
+        try:
+            rules[(category or None, NotificationStatus(status.lower()))] = int(days)
+        except ValueError:
+            raise ValueError(f'Invalid notification retention rule: {part!r}')
+    return rules
+
+
+def _rule_criteria(rules, now):
+    """SQL criteria selecting the notifications each rule expires.
+
+    A category's own rule takes precedence over the rule for all categories
+    with the same status.
+    """
+    from app.models.notification import Notification, category_registry
+
+    criteria = []
+    for (category_name, status), days in rules.items():
+        conditions = [
+            Notification.status == status,
+            Notification.created_at < now - timedelta(days=days)
+        ]
+        if category_name is not None:
+            category_id = category_registry.id_for(category_name)
+            if category_id is None:
+                continue
+            conditions.append(Notification.category_id == category_id)
+        else:
+            overridden = [category_registry.id_for(name) for (name, other), _ in rules.items()
+                          if name is not None and other == status]
+            overridden = [category_id for category_id in overridden if category_id is not None]
+            if overridden:
+                conditions.append(Notification.category_id.is_(None) | Notification.category_id.notin_(overridden))
+        criteria.append((f"{category_name or '*'}.{status.value}", conditions))
+    return criteria
+
+
+def _archive_row(notification):
+    return {
+        'id': notification.id,
+        'user_id': notification.user_id,
+        'category_id': notification.category_id,
+        'notification_type': notification.notification_type,
+        'title': notification.title,
+        'message': notification.message,
+        'link': notification.link,
+        'status': notification.status.value,
+        'created_at': notification.created_at.isoformat(),
+        'read_at': notification.read_at.isoformat() if notification.read_at else None
+    }
+
+
+def archive_notifications(rules, batch_size=500, archive_file=None, now=None):
+    """Move notifications past their retention age out of the live table.
+
+    Expired notifications go to the ``notification_archive`` table, or are
+    appended to the gzipped JSON-lines ``archive_file`` if one is given.
+    Each batch is copied, deleted and committed in its own short
+    transaction, so the live table is never locked for long and the command
+    can be stopped and re-run. Unread counters are lowered for any unread
+    notifications that expire.
+
+    Returns a dict of the number of notifications archived per rule.
+    """
+    from app import db
+    from app.models.notification import ArchivedNotification, Notification, NotificationStatus
+    from app.models.user import User
+
+    now = now or datetime.now()
+    archived = {}
+    for name, conditions in _rule_criteria(rules, now):
+        archived[name] = 0
+        last_id = 0
+        while True:
+            ids = [row_id for (row_id,) in db.session.query(Notification.id).filter(
+                Notification.id > last_id, *conditions
+            ).order_by(Notification.id).limit(batch_size)]
+            if not ids:
+                break
+
+            if archive_file:
+                with gzip.open(archive_file, 'at', encoding='utf-8') as output:
+                    for notification in Notification.query.filter(Notification.id.in_(ids)).order_by(Notification.id):
+                        output.write(json.dumps(_archive_row(notification)) + '\n')
+            else:
+                columns = ArchivedNotification.COPIED_COLUMNS
+                db.session.execute(insert(ArchivedNotification).from_select(
+                    columns,
+                    select(*[getattr(Notification, column) for column in columns]).where(Notification.id.in_(ids))
+                ))
+
+            unread = db.session.query(Notification.user_id, func.count(Notification.id)).filter(
+                Notification.id.in_(ids),
+                Notification.status == NotificationStatus.UNREAD
+            ).group_by(Notification.user_id).all()
+            for user_id, count in unread:
+                User.adjust_unread_count(user_id, -count)
+
+            Notification.query.filter(Notification.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            archived[name] += len(ids)
+            last_id = ids[-1]
+    return archived
+
+
+def _month_start(value, months_ahead=0):
+    month = value.year * 12 + value.month - 1 + months_ahead
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+def _archive_partitions(connection):
+    """``{name: upper bound}`` of the archive table's partitions on MySQL"""
+    rows = connection.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'notification_archive' "
+        "AND PARTITION_NAME IS NOT NULL"
+    )).all()
+    return {name: description.strip("'") for name, description in rows}
+
+
+def _partition_clause(month):
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN ('{_month_start(month, 1):%Y-%m-%d}')"
+
+
+def ensure_archive_partitions(months_ahead=3, now=None):
+    """Split the archive table into monthly partitions on MySQL.
+
+    Partitions are added up to ``months_ahead`` months from now; later rows
+    land in a catch-all ``pmax`` partition until then. Does nothing on other
+    databases. Returns the names of the partitions created.
+    """
+    from app import db
+
+    if db.engine.dialect.name != 'mysql':
+        return []
+    now = now or datetime.now()
+    with db.engine.begin() as connection:
+        existing = _archive_partitions(connection)
+        if not existing:
+            oldest = connection.execute(text('SELECT MIN(created_at) FROM notification_archive')).scalar() or now
+            months = []
+            month = _month_start(oldest)
+            while month <= _month_start(now, months_ahead):
+                months.append(month)
+                month = _month_start(month, 1)
+            connection.execute(text(
+                'ALTER TABLE notification_archive PARTITION BY RANGE COLUMNS(created_at) ('
+                + ', '.join([_partition_clause(month) for month in months]
+                            + ['PARTITION pmax VALUES LESS THAN (MAXVALUE)'])
+                + ')'
+            ))
+        else:
+            months = []
+            month = _month_start(now)
+            while month <= _month_start(now, months_ahead):
+                if f'p{month:%Y%m}' not in existing:
+                    months.append(month)
+                month = _month_start(month, 1)
+            if months:
+                # Only rows beyond the last month live in pmax, so splitting
+                # it moves few or no rows
+                connection.execute(text(
+                    'ALTER TABLE notification_archive REORGANIZE PARTITION pmax INTO ('
+                    + ', '.join([_partition_clause(month) for month in months]
+                                + ['PARTITION pmax VALUES LESS THAN (MAXVALUE)'])
+                    + ')'
+                ))
+    return [f'p{month:%Y%m}' for month in months]
+
+
+def purge_archive(days, batch_size=1000, now=None):
+    """Delete archived notifications created more than ``days`` days ago.
+
+    On a partitioned MySQL archive, whole months past the cutoff are
+    dropped as partitions; the remaining rows are deleted in batches.
+    Returns the names of the dropped partitions and the number of rows
+    deleted in batches.
+    """
+    from app import db
+    from app.models.notification import ArchivedNotification
+
+    cutoff = (now or datetime.now()) - timedelta(days=days)
+    dropped = []
+    if db.engine.dialect.name == 'mysql':
+        with db.engine.begin() as connection:
+            for name, bound in _archive_partitions(connection).items():
+                if name != 'pmax' and datetime.fromisoformat(bound) <= cutoff:
+                    dropped.append(name)
+            if dropped:
+                connection.execute(text(f"ALTER TABLE notification_archive DROP PARTITION {', '.join(dropped)}"))
+
+    deleted = 0
+    while True:
+        # Archived ids are unique, as they were the live table's primary keys
+        ids = [row_id for (row_id,) in db.session.query(ArchivedNotification.id).filter(
+            ArchivedNotification.created_at < cutoff
+        ).limit(batch_size)]
+        if not ids:
+            break
+        ArchivedNotification.query.filter(
+            ArchivedNotification.id.in_(ids),
+            ArchivedNotification.created_at < cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+    return dropped, deleted
@@ -0,0 +1,334 @@
+import re
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import and_, column, func, literal_column, select, table, text
+from app import db
+from app.utils.text import html_to_text
+
+# Each post and comment is one document. Document ids interleave the two
+# kinds so they never collide: posts get even ids, comments odd ones.
+KIND_POST = 'post'
+KIND_COMMENT = 'comment'
+
+# Markers wrapped around matched terms in snippets, replaced by <mark> tags
+# after the snippet text has been escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+
+def document_id(kind, object_id):
+    return object_id * 2 + (1 if kind == KIND_COMMENT else 0)
+
+
+def prefix_match(column, prefix):
+    """Criterion matching values of ``column`` that start with ``prefix``,
+    ignoring case.
+
+    Written as a range over ``lower(column)`` rather than ``ILIKE
+    'prefix%'`` so that an index on ``lower(column)`` is used on every
+    database, whatever its LIKE collation. SQLite's lower() only folds
+    ASCII letters, as its ILIKE did.
+    """
+    prefix = prefix.lower()
+    lowered = func.lower(column)
+    # The range ends just past the last character that can be incremented;
+    # a prefix of only U+10FFFF has no end
+    stem = prefix.rstrip(chr(0x10FFFF))
+    if not stem:
+        return lowered >= prefix
+    following = ord(stem[-1]) + 1
+    if 0xD800 <= following <= 0xDFFF:
+        following = 0xE000
+    return and_(lowered >= prefix, lowered < stem[:-1] + chr(following))
+
+
+def search_terms(query):
+    """Split a user's query into plain word terms"""
+    return re.findall(r'\w+', query or '', re.UNICODE)[:20]
+
+
+def highlight_snippet(snippet):
+    """Escape snippet text and turn the match markers into <mark> tags"""
+    html = str(escape(snippet))
+    html = html.replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+    return Markup(html)
+
+
+def make_snippet(body, terms, width=160):
+    """Cut a window of ``body`` around the first matched term and mark the matches"""
+    body = body or ''
+    lowered = body.lower()
+    positions = [lowered.find(term.lower()) for term in terms]
+    positions = [position for position in positions if position >= 0]
+    start = max(0, min(positions) - width // 4) if positions else 0
+    snippet = body[start:start + width]
+    if start > 0:
+        snippet = '...' + snippet
+    if start + width < len(body):
+        snippet += '...'
+    if terms:
+        pattern = re.compile('(' + '|'.join(re.escape(term) for term in terms) + ')', re.IGNORECASE)
+        snippet = pattern.sub(MATCH_START + r'\1' + MATCH_END, snippet)
+    return snippet
+
+
+class SearchResult:
+    def __init__(self, kind, object_id, post_id, post_title, snippet):
+        self.kind = kind
+        self.object_id = object_id
+        self.post_id = post_id
+        self.post_title = post_title
+        self.snippet = highlight_snippet(snippet)
+
+    @property
+    def comment_id(self):
+        return self.object_id if self.kind == KIND_COMMENT else None
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'post_id': self.post_id,
+            'comment_id': self.comment_id,
+            'post_title': self.post_title,
+            'snippet': str(self.snippet)
+        }
+
+
+class SQLiteSearchBackend:
+    """Full-text index stored in an SQLite FTS5 virtual table"""
+
+    documents = table(
+        'search_index',
+        column('rowid'), column('title'), column('body'),
+        column('kind'), column('object_id'), column('post_id')
+    )
+
+    def create_schema(self, connection):
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+            "title, body, kind UNINDEXED, object_id UNINDEXED, post_id UNINDEXED, "
+            "tokenize='porter unicode61')"
+        ))
+
+    def clear(self):
+        db.session.execute(text('DELETE FROM search_index'))
+
+    def upsert(self, kind, object_id, post_id, title, body):
+        rowid = document_id(kind, object_id)
+        db.session.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), {'rowid': rowid})
+        db.session.execute(text(
+            'INSERT INTO search_index (rowid, title, body, kind, object_id, post_id) '
+            'VALUES (:rowid, :title, :body, :kind, :object_id, :post_id)'
+        ), {'rowid': rowid, 'title': title, 'body': body, 'kind': kind,
+            'object_id': object_id, 'post_id': post_id})
+
+    def delete(self, document_ids):
+        for rowid in document_ids:
+            db.session.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), {'rowid': rowid})
+
+    def query(self, terms, visibility, posts_only, limit, offset):
+        from app.models.post import Post
+
+        # Quote every term so FTS5 syntax in the input is matched literally,
+        # and let the last one match as a prefix while the user is typing
+        match = ' '.join(f'"{term}"' for term in terms) + '*'
+        documents = self.documents
+        stmt = select(
+            documents.c.kind, documents.c.object_id, documents.c.post_id, Post.title,
+            literal_column(
+                f"snippet(search_index, 1, '{MATCH_START}', '{MATCH_END}', '...', 24)"
+            ).label('snippet')
+        ).select_from(
+            documents.join(Post.__table__, Post.id == documents.c.post_id)
+        ).where(
+            text('search_index MATCH :match')
+        ).order_by(
+            # Title matches weigh more than body matches; lower bm25 is better
+            literal_column('bm25(search_index, 10.0, 1.0)')
+        ).limit(limit).offset(offset)
+        if visibility is not None:
+            stmt = stmt.where(visibility)
+        if posts_only:
+            stmt = stmt.where(documents.c.kind == KIND_POST)
+
+        rows = db.session.execute(stmt, {'match': match}).all()
+        return [SearchResult(row.kind, row.object_id, row.post_id, row.title, row.snippet) for row in rows]
+
+
+class MySQLSearchBackend:
+    """Full-text index stored in an InnoDB table with a FULLTEXT index"""
+
+    documents = table(
+        'search_document',
+        column('id'), column('title'), column('body'),
+        column('kind'), column('object_id'), column('post_id')
+    )
+
+    def create_schema(self, connection):
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS search_document ('
+            'id BIGINT NOT NULL PRIMARY KEY, '
+            'kind VARCHAR(10) NOT NULL, '
+            'object_id INTEGER NOT NULL, '
+            'post_id INTEGER NOT NULL, '
+            'title VARCHAR(100) NOT NULL DEFAULT \'\', '
+            'body MEDIUMTEXT NOT NULL, '
+            'INDEX ix_search_document_post_id (post_id), '
+            'FULLTEXT INDEX ft_search_document (title, body)'
+            ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4'
+        ))
+
+    def clear(self):
+        db.session.execute(text('DELETE FROM search_document'))
+
+    def upsert(self, kind, object_id, post_id, title, body):
+        db.session.execute(text(
+            'REPLACE INTO search_document (id, kind, object_id, post_id, title, body) '
+            'VALUES (:id, :kind, :object_id, :post_id, :title, :body)'
+        ), {'id': document_id(kind, object_id), 'kind': kind, 'object_id': object_id,
+            'post_id': post_id, 'title': title, 'body': body})
+
+    def delete(self, document_ids):
+        if document_ids:
+            db.session.execute(
+                self.documents.delete().where(self.documents.c.id.in_(list(document_ids)))
+            )
+
+    def query(self, terms, visibility, posts_only, limit, offset):
+        from app.models.post import Post
+
+        documents = self.documents
+        match = 'MATCH (search_document.title, search_document.body) AGAINST (:match IN NATURAL LANGUAGE MODE)'
+        stmt = select(
+            documents.c.kind, documents.c.object_id, documents.c.post_id, Post.title,
+            documents.c.body, literal_column(match).label('score')
+        ).select_from(
+            documents.join(Post.__table__, Post.id == documents.c.post_id)
+        ).where(
+            text(match)
+        ).order_by(
+            literal_column('score').desc()
+        ).limit(limit).offset(offset)
+        if visibility is not None:
+            stmt = stmt.where(visibility)
+        if posts_only:
+            stmt = stmt.where(documents.c.kind == KIND_POST)
+
+        rows = db.session.execute(stmt, {'match': ' '.join(terms)}).all()
+        return [
+            SearchResult(row.kind, row.object_id, row.post_id, row.title, make_snippet(row.body, terms))
+            for row in rows
+        ]
+
+
+class SearchIndex:
+    """Full-text index over post titles, post content and comments.
+
+    The index is written in the same transaction as the post or comment it
+    describes. The backend is chosen from the database dialect: FTS5 on
+    SQLite and a FULLTEXT index on MySQL. Other databases have no search.
+    """
+
+    backends = {
+        'sqlite': SQLiteSearchBackend,
+        'mysql': MySQLSearchBackend
+    }
+
+    def __init__(self):
+        self._backend = None
+        self._schema_ready = False
+
+    def init_app(self, app):
+        @app.before_request
+        def ensure_search_schema():
+            if not self._schema_ready:
+                self.ensure_schema()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            backend_class = self.backends.get(db.engine.dialect.name)
+            self._backend = backend_class() if backend_class else False
+        return self._backend or None
+
+    @property
+    def available(self):
+        return self.backend is not None
+
+    def ensure_schema(self):
+        """Create the index table if it does not exist yet"""
+        if self.backend is not None:
+            try:
+                with db.engine.begin() as connection:
+                    self.backend.create_schema(connection)
+            except Exception as e:
+                current_app.logger.error(f'Could not create the search index: {e}')
+                return
+        self._schema_ready = True
+
+    def index_post(self, post):
+        if self.backend is not None:
+            self.backend.upsert(KIND_POST, post.id, post.id, post.title, html_to_text(post.content))
+
+    def index_comment(self, comment):
+        if self.backend is not None:
+            self.backend.upsert(KIND_COMMENT, comment.id, comment.post_id, '', html_to_text(comment.content))
+
+    def remove_post(self, post_id, comment_ids=()):
+        """Remove a post and the given comments on it from the index"""
+        if self.backend is not None:
+            ids = [document_id(KIND_POST, post_id)]
+            ids += [document_id(KIND_COMMENT, comment_id) for comment_id in comment_ids]
+            self.backend.delete(ids)
+
+    def remove_comments(self, comment_ids):
+        if self.backend is not None:
+            self.backend.delete([document_id(KIND_COMMENT, comment_id) for comment_id in comment_ids])
+
+    def search(self, query, user, page=1, per_page=10):
+        """Ranked results for ``query`` among the posts ``user`` may see.
+
+        Returns a (results, has_next) pair. Anonymous visitors cannot read
+        comments, so their results only include posts.
+        """
+        from app.models.post import Post
+
+        terms = search_terms(query)
+        if self.backend is None or not terms:
+            return [], False
+        offset = (max(page, 1) - 1) * per_page
+        results = self.backend.query(
+            terms,
+            visibility=Post.visibility_filter(user),
+            posts_only=not user.is_authenticated,
+            limit=per_page + 1,
+            offset=offset
+        )
+        return results[:per_page], len(results) > per_page
+
+    def rebuild(self, batch_size=500):
+        """Re-index every post and comment from scratch"""
+        from app.models.post import Post
+        from app.models.comment import Comment
+
+        self.ensure_schema()
+        if self.backend is None:
+            return 0
+        self.backend.clear()
+        indexed = 0
+        for model, index in ((Post, self.index_post), (Comment, self.index_comment)):
+            last_id = 0
+            while True:
+                batch = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+                if not batch:
+                    break
+                for item in batch:
+                    index(item)
+                last_id = batch[-1].id
+                indexed += len(batch)
+                db.session.commit()
+        db.session.commit()
+        return indexed
+
+
+search_index = SearchIndex()
@@ -0,0 +1,25 @@
+import math
+from markupsafe import Markup
+
+# Average adult reading speed used for the reading time estimate
+WORDS_PER_MINUTE = 200
+
+
+def html_to_text(html):
+    """Convert stored HTML content to plain text with entities decoded"""
+    if not html:
+        return ''
+    return Markup(html).striptags()
+
+
+def make_excerpt(text, length=300):
+    """Shorten ``text`` to at most ``length`` characters on a word boundary"""
+    if len(text) <= length:
+        return text
+    excerpt = text[:length - 3].rsplit(' ', 1)[0]
+    return excerpt + '...'
+
+
+def reading_time(word_count):
+    """Estimated reading time in whole minutes (at least one)"""
+    return max(1, math.ceil(word_count / WORDS_PER_MINUTE))
@@ -1,4 +1,9 @@
 from app import create_app, db, bcrypt
+from app.commands import (
+    backfill_comment_paths, backfill_content_html, reconcile_comment_counts, reconcile_notification_counts,
+    reconcile_post_counts
+)
+from app.utils.search import search_index
 from app.models.user import User
 from app.models.post import Post
 from app.models.comment import Comment
@@ -198,6 +203,10 @@ console.log(`The sum is ${result}`);
     )
     db.session.add(syntax_guide_post)
     
+    # Compute the plain-text excerpts shown in post listings
+    for post in [post1, post2, post3, post_with_code, syntax_guide_post]:
+        post.update_summary()
+    
     db.session.commit()
     
     # Add sample comments
@@ -262,6 +271,17 @@ console.log(`The sum is ${result}`);
     db.session.add_all([reply1, reply2])
     db.session.commit()
     
+    # Store each comment's position in its thread and the comment counters
+    backfill_comment_paths()
+    reconcile_comment_counts()
+    reconcile_post_counts()
+    
+    # Highlight the code blocks in the sample posts and comments
+    backfill_content_html()
+    
+    # Index the sample posts and comments for search
+    search_index.rebuild()
+    
     # Create default notification categories
     categories = [
         NotificationCategory(name="Comments", description="Notifications about comments on your posts", icon="fa-comment"),
@@ -317,6 +337,9 @@ console.log(`The sum is ${result}`);
     db.session.add_all([notification1, notification2, notification3])
     db.session.commit()
     
+    # Store each user's unread notification count
+    reconcile_notification_counts()
+    
     print('Database initialized with admin user, sample data, comments, and notifications.')
 
     # Create profile pictures directory if it doesn't exist
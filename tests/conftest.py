@@ -0,0 +1,39 @@
+import os
+
+# The configuration reads the database URL when it is imported
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+import pytest
+from app import create_app, db
+from app.models.user import User
+from app.utils.search import search_index
+
+
+@pytest.fixture
+def app():
+    app = create_app()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        db.create_all()
+        search_index.ensure_schema()
+    # No application context is left pushed, so each test request gets a
+    # session of its own, as it would in production
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+def make_user(username, role='user'):
+    user = User(username=username, first_name=username.title(), last_name='Tester',
+                email=f'{username}@example.com', role=role, is_approved=True)
+    user.set_password('secret')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(app, email):
+    client = app.test_client()
+    response = client.post('/login', data={'email': email, 'password': 'secret'})
+    assert response.status_code == 302
+    return client
@@ -0,0 +1,104 @@
+"""Listings must load their posts' authors and editors up front, and post
+pages their comments' authors, so the number of statements a page runs does
+not grow with the posts or comments it shows."""
+import pytest
+from sqlalchemy import event
+from app import db
+from app.models.comment import Comment
+from app.models.post import Post
+from app.models.user import User
+from app.utils.cache import post_cache
+from app.utils.search import search_index
+from tests.conftest import login, make_user
+
+
+def add_posts(app, count):
+    with app.app_context():
+        admin = User.query.filter_by(username='admin').one()
+        editor = User.query.filter_by(username='editor').one()
+        for number in range(count):
+            # Every other post has an author of its own, so a lazy load per
+            # author would show; the rest are the admin's, for their profile
+            author = admin if number % 2 else make_user(f'author{Post.query.count()}')
+            post = Post(title=f'Listing post {number}', content=f'Body of listing post {number}',
+                        author=author, last_modified_by=editor)
+            post.update_summary()
+            post.render_content()
+            db.session.add(post)
+            db.session.flush()
+            search_index.index_post(post)
+            db.session.commit()
+
+
+def add_comments(app, post_id, count):
+    with app.app_context():
+        post = Post.query.get(post_id)
+        for number in range(count):
+            # Each comment has an author of its own, so a lazy load per
+            # author would show
+            comment = Comment(content=f'Comment {number}', post=post,
+                              author=make_user(f'commenter{Comment.query.count()}'))
+            comment.render_content()
+            db.session.add(comment)
+            db.session.flush()
+            comment.assign_path(None)
+            Post.adjust_comment_count(post.id, 1)
+            db.session.commit()
+
+
+def statements_run(app, client, url):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    # The first request fills per-process caches, such as the category registry
+    assert client.get(url).status_code == 200
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        assert client.get(url).status_code == 200
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return len(statements)
+
+
+@pytest.mark.parametrize('url', ['/', '/user/admin', '/admin/posts', '/search?q=listing'])
+def test_listing_statements_do_not_grow_with_posts(app, url):
+    with app.app_context():
+        make_user('admin', role='admin')
+        make_user('editor')
+        if url.startswith('/search') and not search_index.available:
+            pytest.skip('No full-text search backend on this database')
+    client = login(app, 'admin@example.com')
+
+    add_posts(app, 2)
+    few_posts = statements_run(app, client, url)
+
+    add_posts(app, 8)
+    many_posts = statements_run(app, client, url)
+
+    assert many_posts == few_posts
+
+
+def test_post_page_statements_do_not_grow_with_comments(app, monkeypatch):
+    # The comment thread must be rendered on every request, not served from
+    # the page cache
+    monkeypatch.setattr(post_cache, 'enabled', False)
+    with app.app_context():
+        make_user('admin', role='admin')
+        make_user('editor')
+    client = login(app, 'admin@example.com')
+    add_posts(app, 1)
+    with app.app_context():
+        post_id = Post.query.one().id
+    url = f'/post/{post_id}'
+
+    add_comments(app, post_id, 2)
+    few_comments = statements_run(app, client, url)
+
+    add_comments(app, post_id, 6)
+    many_comments = statements_run(app, client, url)
+
+    assert many_comments == few_comments
@@ -0,0 +1,54 @@
+"""A recipient the mail server refuses must not stop the other users'
+notification emails, on this run or the next."""
+import smtplib
+from contextlib import contextmanager
+from app import db
+from app.models.notification import Notification, NotificationSettings, NotificationStatus
+from app.utils import digest
+from tests.conftest import make_user
+
+
+class FakeConnection:
+    """Records the messages sent, refusing those to ``refused``"""
+
+    def __init__(self, refused):
+        self.refused = refused
+        self.sent = []
+
+    def send(self, message):
+        if message['To'] in self.refused:
+            raise smtplib.SMTPRecipientsRefused({message['To']: (550, b'No such user')})
+        self.sent.append(message['To'])
+
+
+def test_refused_recipient_does_not_block_the_rest(app, monkeypatch):
+    connection = FakeConnection(refused={'bounce@example.com'})
+
+    @contextmanager
+    def fake_mail_connection(app):
+        yield connection
+
+    monkeypatch.setattr(digest, 'mail_connection', fake_mail_connection)
+
+    with app.app_context():
+        user_ids = {}
+        for username in ('first', 'bounce', 'third'):
+            user = make_user(username)
+            db.session.add(NotificationSettings(user_id=user.id, email_enabled=True, email_digest=False))
+            db.session.add(Notification(user_id=user.id, notification_type=Notification.TYPE_SYSTEM,
+                                        title='Hello', message=f'Hello {username}',
+                                        status=NotificationStatus.UNREAD))
+            db.session.commit()
+            NotificationSettings.invalidate(user.id)
+            user_ids[username] = user.id
+
+        assert digest.send_notification_emails(app, digest=False) == 2
+        assert digest.send_notification_emails(app, digest=False) == 0
+
+        # Each deliverable user is emailed exactly once; the refused one is
+        # left to be retried
+        assert connection.sent == ['first@example.com', 'third@example.com']
+        emailed = dict(db.session.query(Notification.user_id, Notification.emailed_at))
+        assert emailed[user_ids['first']] is not None
+        assert emailed[user_ids['third']] is not None
+        assert emailed[user_ids['bounce']] is None
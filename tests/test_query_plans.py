@@ -0,0 +1,11 @@
+"""The notification routes' queries must be served by indexes, so they stay
+fast however many notifications there are (see `flask check-query-plans`)."""
+from app.commands import check_notification_query_plans
+
+
+def test_no_notification_query_scans_a_whole_table(app):
+    with app.app_context():
+        results = check_notification_query_plans()
+    assert results
+    scanning = {name: plan for name, plan, scans in results if scans}
+    assert scanning == {}